@@ -0,0 +1,341 @@
+# coding: utf-8
+"""
+    fluenpy.bench
+    ~~~~~~~~~~~~~
+
+    Throughput benchmark for each stage of the pipeline::
+
+        $ python -m fluenpy.bench
+        $ python -m fluenpy.bench --stage parser.json --stage forward -n 200000
+        $ python -m fluenpy.bench --stage match -n 1000000
+
+    Each stage processes synthetic events in batches and reports events/sec,
+    bytes/sec and the p50/p99 latency of one batch as JSON.
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+import logging
+log = logging.getLogger(__name__)
+
+import io
+import json
+import platform
+import random
+import sys
+from functools import partial
+from optparse import OptionParser
+from time import time as now
+
+import gevent
+import gevent.socket as socket
+
+from fluenpy import config
+from fluenpy.engine import Engine, EngineClass
+from fluenpy.match import Match, MatchTrie
+from fluenpy.event import ArrayEventStream
+from fluenpy.output import Output
+from fluenpy.parser import TextParser
+from fluenpy.plugin import Plugin
+from fluenpy.version import __version__
+
+SAMPLE_LINES = {
+    'apache': '192.168.0.1 - - [28/Feb/2013:12:00:00 +0100] "GET / HTTP/1.1" 200 777',
+    'apache2': ('192.168.0.1 - - [27/Feb/2013:20:00:00 -0900] "GET / HTTP/1.1" '
+                '200 777 "-" "Opera/12.0"'),
+    'nginx': ('127.0.0.1 192.168.0.1 - [28/Feb/2013:12:00:00 +0900] '
+              '"GET / HTTP/1.1" 200 777 "-" "Opera/12.0"'),
+    'syslog': 'Feb 28 12:00:00 192.168.0.1 fluentd[11111]: [error] Syslog test',
+    'json': '{"time":1362020400,"host":"192.168.0.1","size":777,"method":"PUT"}',
+    'ltsv': 'host:192.168.0.1\treq:GET /list HTTP/1.1\tstatus:200\tsize:777',
+    }
+
+
+def make_records(n):
+    t = int(now())
+    return [(t, {'host': '192.168.0.%d' % (i % 256), 'method': 'GET',
+                 'path': '/item/%d' % (i,), 'code': 200, 'size': 777})
+            for i in range(n)]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    idx = int(round(p / 100 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+class Result(object):
+    u"""1ステージ分の計測結果. バッチ毎に ``add`` を呼ぶ."""
+
+    def __init__(self):
+        self.events = 0
+        self.bytes = 0
+        self.latencies = []
+        self._start = now()
+        self.elapsed = None
+
+    def add(self, events, nbytes, latency):
+        self.events += events
+        self.bytes += nbytes
+        self.latencies.append(latency)
+
+    def finish(self):
+        self.elapsed = now() - self._start
+        return self
+
+    def to_dict(self):
+        lat = sorted(self.latencies)
+        elapsed = self.elapsed or 1e-9
+        return dict(
+            events=self.events,
+            bytes=self.bytes,
+            seconds=elapsed,
+            events_per_sec=self.events / elapsed,
+            bytes_per_sec=self.bytes / elapsed,
+            batches=len(lat),
+            latency_p50=percentile(lat, 50),
+            latency_p99=percentile(lat, 99),
+            )
+
+
+def bench_parser(n, batch, format='apache'):
+    parser = TextParser()
+    parser.configure({'format': format})
+    line = SAMPLE_LINES[format]
+    lines = [line] * batch
+    result = Result()
+    parse = parser.parse
+    for _ in range(0, n, batch):
+        t = now()
+        for l in lines:
+            parse(l)
+        result.add(batch, len(line) * batch, now() - t)
+    return result.finish()
+
+
+class _CountOutput(Output):
+    def __init__(self):
+        super(_CountOutput, self).__init__()
+        self.count = 0
+
+    def emit(self, tag, es):
+        self.count += len(es)
+
+Plugin.register_output('bench_count', _CountOutput)
+
+
+def bench_routing(n, batch, matches=100, tags=1000):
+    conf = ''.join("<match bench.%d.**>\n type null\n</match>\n" % i
+                   for i in range(matches))
+    conf += "<match **>\n type bench_count\n</match>\n"
+    engine = EngineClass()
+    engine.configure(config.parse(io.BytesIO(conf), 'bench.conf'))
+    records = make_records(batch)
+    tag_list = ['bench.%d.x' % (i * 7 % (matches * 2),) for i in range(tags)]
+    result = Result()
+    for i in range(0, n, batch):
+        tag = tag_list[(i // batch) % tags]
+        es = ArrayEventStream(records)
+        t = now()
+        engine.emit_stream(tag, es)
+        result.add(batch, 0, now() - t)
+    return result.finish()
+
+
+def make_patterns(n):
+    patterns = []
+    for i in range(n):
+        kind = i % 5
+        if kind == 0:
+            p = "app%d.*" % i
+        elif kind == 1:
+            p = "svc%d.**" % i
+        elif kind == 2:
+            p = "host%d.access host%d.error" % (i, i)
+        elif kind == 3:
+            p = "*.job%d" % i
+        else:
+            p = "web%d.*.log" % i
+        patterns.append(p)
+    patterns.append("**")
+    return patterns
+
+
+def bench_match(n, batch, router='trie', patterns=1000):
+    u"""
+    *n* 個の異なる tag を *patterns* 個のパターンに振り分ける.
+    *router* が trie なら ``MatchTrie``, scan なら ``Match`` を順に試す.
+    """
+    rnd = random.Random(0)
+    matches = [Match(p, p) for p in make_patterns(patterns)]
+    prefixes = ['app', 'svc', 'host', 'web', 'other']
+    tags = ["%s%d.%s.%d" % (rnd.choice(prefixes), rnd.randrange(patterns * 2),
+                            rnd.choice(['access', 'error', 'log']), i)
+            for i in range(n)]
+    if router == 'trie':
+        route = MatchTrie(matches).match
+    else:
+        def route(tag):
+            for m in matches:
+                if m.match(tag):
+                    return m
+    result = Result()
+    for i in range(0, n, batch):
+        t = now()
+        for tag in tags[i:i+batch]:
+            route(tag)
+        result.add(len(tags[i:i+batch]), 0, now() - t)
+    return result.finish()
+
+
+def bench_pack(n, batch):
+    records = make_records(batch)
+    result = Result()
+    for _ in range(0, n, batch):
+        es = ArrayEventStream(records)
+        t = now()
+        data = es.to_mpac()
+        result.add(batch, len(data), now() - t)
+    return result.finish()
+
+
+def bench_buffer(n, batch, chunk_limit='8m'):
+    buf = Plugin.new_buffer('memory')
+    buf.configure({'buffer_chunk_limit': chunk_limit, 'buffer_queue_limit': '1024'})
+    buf.start()
+    data = ArrayEventStream(make_records(batch)).to_mpac()
+    result = Result()
+    for _ in range(0, n, batch):
+        t = now()
+        buf.emit('bench', data)
+        while 1:
+            try:
+                buf.purge(buf.get_nowait())
+            except gevent.queue.Empty:
+                break
+        result.add(batch, len(data), now() - t)
+    buf.shutdown()
+    return result.finish()
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def bench_forward(n, batch):
+    u"""in_forward と out_forward をループバックで繋ぎ、受信側で数える."""
+    port = _free_port()
+    conf = """
+<source>
+  type forward
+  bind 127.0.0.1
+  port %d
+</source>
+<match bench.**>
+  type bench_count
+</match>
+""" % (port,)
+    Engine.configure(config.parse(io.BytesIO(conf), 'bench.conf'))
+    counter = Engine._matches[0].output
+    for s in Engine._sources:
+        s.start()
+
+    out = Plugin.new_output('forward')
+    out.configure(config.parse(io.BytesIO(
+        "<match>\n<server>\n host 127.0.0.1\n port %d\n</server>\n</match>\n" % (port,)),
+        'bench.conf').elements[0])
+    out.start()
+
+    buf = Plugin.new_buffer('memory')
+    buf.configure({})
+    data = ArrayEventStream(make_records(batch)).to_mpac()
+
+    result = Result()
+    sent = 0
+    try:
+        for _ in range(0, n, batch):
+            chunk = buf.new_chunk('bench.forward', 0)
+            chunk += data
+            t = now()
+            out.write(chunk)
+            result.add(batch, len(data), now() - t)
+            sent += batch
+            gevent.sleep(0)
+        deadline = now() + 60
+        while counter.count < sent and now() < deadline:
+            gevent.sleep(0.01)
+        result.finish()
+    finally:
+        out.shutdown()
+        for s in Engine._sources:
+            s.shutdown()
+    if counter.count < sent:
+        log.error("forward: only %d of %d events are received.", counter.count, sent)
+    return result
+
+
+STAGES = [('parser.' + f, partial(bench_parser, format=f))
+          for f in sorted(SAMPLE_LINES)]
+STAGES += [
+    ('routing', bench_routing),
+    ('match.trie', partial(bench_match, router='trie')),
+    ('match.scan', partial(bench_match, router='scan')),
+    ('pack', bench_pack),
+    ('buffer', bench_buffer),
+    ('forward', bench_forward),
+    ]
+
+#: 遅いので --stage で指定した時だけ実行するステージ.
+SLOW_STAGES = ('match.scan',)
+
+
+def run(stages=None, events=100000, batch=1000):
+    Plugin.load_plugins()
+    results = {}
+    for name, func in STAGES:
+        if stages and not any(name == s or name.startswith(s + '.') for s in stages):
+            continue
+        if not stages and name in SLOW_STAGES:
+            continue
+        log.info("running stage %s", name)
+        results[name] = func(events, batch).to_dict()
+    return dict(
+        version=__version__,
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        events=events,
+        batch=batch,
+        stages=results,
+        )
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--stage', action='append', dest='stages',
+                      help="stage to run (can be repeated). 'parser' runs all "
+                           "parser.* stages. default: all except match.scan")
+    parser.add_option('-n', '--events', type='int', default=100000,
+                      help="number of events per stage")
+    parser.add_option('-b', '--batch', type='int', default=1000,
+                      help="number of events per batch")
+    parser.add_option('-o', '--output', help="write JSON to this file")
+    opts, args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARN)
+
+    report = json.dumps(run(opts.stages, opts.events, opts.batch),
+                        indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
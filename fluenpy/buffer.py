@@ -11,8 +11,18 @@ import logging
 log = logging.getLogger(__name__)
 
 from fluenpy.config import Configurable, config_param
+from fluenpy.plugin import Plugin
+from fluenpy.error import ConfigError, BufferQueueLimitError, BufferTotalLimitError
 
+import gevent
+import gevent.event
 import gevent.queue
+import heapq
+import os
+import itertools
+import weakref
+import zlib
+from collections import deque
 from time import time as now
 
 try:
@@ -21,63 +31,539 @@ except ImportError:
     from io import BytesIO
 
 
+#: gzip 形式で圧縮・伸長する時の zlib の wbits
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class GzipReader(object):
+    u"""
+    gzip で圧縮されたファイルを読みながら伸長する file-like オブジェクト.
+    複数のメンバーが連結されたデータも読める. 途中で切れているデータは
+    読めたところまでを返す.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._d = zlib.decompressobj(GZIP_WBITS)
+        self._buf = b''
+        self._eof = False
+
+    def _decompress(self, data):
+        out = self._d.decompress(data)
+        while self._d.unused_data:
+            # 次のメンバー
+            data = self._d.unused_data
+            self._d = zlib.decompressobj(GZIP_WBITS)
+            out += self._d.decompress(data)
+        return out
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            data = self._f.read(64 * 1024)
+            if not data:
+                self._buf += self._d.flush()
+                self._eof = True
+                break
+            self._buf += self._decompress(data)
+        if size < 0:
+            result, self._buf = self._buf, b''
+        else:
+            result, self._buf = self._buf[:size], self._buf[size:]
+        return result
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class BaseBufferChunk(object):
+    u"""
+    バッファのチャンク. 継承したクラスは格納したバイト列をそのまま返す
+    ``raw_read`` などを実装する. ``compressed`` が true のチャンクは gzip で
+    圧縮したデータを格納し、 ``read``, ``segments``, ``open`` は伸長した
+    データを返す.
+    """
+
+    #: MemoryBudget から確保しているバイト数
+    accounted = 0
+
+    compressed = False
+    _compressor = None
+
+    #: レコード数と、イベントの時刻の最小値と最大値
+    records = 0
+    first_time = last_time = None
+
     def __init__(self, key, expire):
         self.key = key
         self.expire = expire
+        self.created_at = now()
+
+    def add_metadata(self, records, first_time=None, last_time=None):
+        u"""追記したデータの *records* と時刻の範囲をメタデータに加える."""
+        self.records += records
+        if first_time is not None and (self.first_time is None or
+                                       first_time < self.first_time):
+            self.first_time = first_time
+        if last_time is not None and (self.last_time is None or
+                                      last_time > self.last_time):
+            self.last_time = last_time
+
+    def metadata(self):
+        return dict(key=self.key, size=len(self), records=self.records,
+                    first_time=self.first_time, last_time=self.last_time,
+                    created_at=self.created_at)
 
     def __iadd__(self, data):
-        """Append *data* to this chunk."""
+        """Append *data* to this chunk as is."""
         raise NotImplemented
 
     def __len__(self):
         """Return bytesize of this chunk."""
         raise NotImplemented
 
+    def start_compress(self):
+        u"""これ以降 ``append`` したデータを gzip で圧縮して格納する."""
+        self.compressed = True
+
+    def append(self, data, compressed=False):
+        u"""
+        *data* を追記して、格納したバイト数を返す.
+        *compressed* が true なら *data* は gzip で圧縮済みのデータで、
+        圧縮しなおさずに gzip のメンバーとして連結する.
+        """
+        if compressed:
+            stored = self._close_member()
+            self += data
+            return stored + len(data)
+        if self.compressed:
+            if self._compressor is None:
+                self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                                    zlib.DEFLATED, GZIP_WBITS)
+            data = self._compressor.compress(data)
+            if not data:
+                return 0
+        self += data
+        return len(data)
+
+    def _close_member(self):
+        if self._compressor is None:
+            return 0
+        data = self._compressor.flush()
+        self._compressor = None
+        self += data
+        return len(data)
+
+    def finish(self):
+        u"""キューに入れる前に呼ばれる. 圧縮中なら gzip のデータを完結させる."""
+        self._close_member()
+
+    def raw_read(self):
+        """Return data stored in this chunk (compressed if ``compressed``)."""
+        raise NotImplemented
+
+    def raw_segments(self):
+        """Return list of byte strings stored in this chunk."""
+        return [self.raw_read()]
+
+    def raw_open(self):
+        """Return file-like readable object for stored data."""
+        return BytesIO(self.raw_read())
+
     def read(self):
         """Return data written to this chunk."""
-        raise NotImplemented
+        if self.compressed:
+            with self.open() as f:
+                return f.read()
+        return self.raw_read()
+
+    def segments(self):
+        """Return list of byte strings which makes up this chunk."""
+        if self.compressed:
+            return [self.read()]
+        return self.raw_segments()
 
     def open(self):
         """Return file-like readable object for this chunk."""
-        return BytesIO(self.read())
+        if self.compressed:
+            return GzipReader(self.raw_open())
+        return self.raw_open()
 
     def purge(self):
         """Called when throw away this chunk."""
         pass
 
 
+class MemoryBudgetClass(object):
+    u"""
+    すべての出力のメモリバッファで共有する、プロセス全体のメモリ使用量の上限.
+    ``<system>`` の ``total_limit_size`` で設定する. 0 なら上限なし.
+
+    上限に達した時の動作は *policy* で決める.
+
+    block
+        他のバッファが書き出されて空くまで *block_timeout* 秒待つ.
+        それでも空かなければ ``BufferTotalLimitError`` を送出する.
+    drop_oldest
+        キューに入っているチャンクのうち一番古いものを捨てる.
+    reject
+        すぐに ``BufferTotalLimitError`` を送出する.
+    """
+
+    POLICIES = ('block', 'drop_oldest', 'reject')
+
+    def __init__(self):
+        self.limit = 0
+        self.policy = 'block'
+        self.block_timeout = 10
+        self.usage = 0
+        self.blocked = self.rejected = 0
+        self.dropped_chunks = self.dropped_bytes = 0
+        self._buffers = weakref.WeakSet()
+        self._released = gevent.event.Event()
+
+    def configure(self, limit, policy='block', block_timeout=10):
+        if policy not in self.POLICIES:
+            raise ConfigError("total_limit_policy should be one of %s: %r" %
+                              (', '.join(self.POLICIES), policy))
+        self.limit = limit
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+    def register(self, buffer):
+        self._buffers.add(buffer)
+
+    def _available(self, size):
+        return not self.limit or self.usage + size <= self.limit
+
+    def acquire(self, size):
+        if not self._available(size):
+            if self.policy == 'block':
+                self.blocked += 1
+                deadline = now() + self.block_timeout
+                while not self._available(size):
+                    timeout = deadline - now()
+                    if timeout <= 0:
+                        break
+                    self._released.clear()
+                    self._released.wait(timeout)
+            elif self.policy == 'drop_oldest':
+                while not self._available(size) and self._drop_oldest():
+                    pass
+            if not self._available(size):
+                self.rejected += 1
+                raise BufferTotalLimitError(
+                        "total_limit_size is exceeded: usage=%d limit=%d" %
+                        (self.usage, self.limit))
+        self.usage += size
+
+    def release(self, size):
+        if size:
+            self.usage -= size
+            self._released.set()
+
+    def _drop_oldest(self):
+        oldest = None
+        for buf in self._buffers:
+            chunk = buf.peek()
+            # 使用量に数えていないチャンクを捨てても空きは増えない.
+            if chunk is None or not chunk.accounted:
+                continue
+            if oldest is None or chunk.created_at < oldest[1].created_at:
+                oldest = (buf, chunk)
+        if oldest is None:
+            return False
+        buf, chunk = oldest
+        log.warn("total_limit_size is exceeded. dropping the oldest chunk: "
+                 "key=%r size=%d", chunk.key, len(chunk))
+        buf.get_nowait()
+        self.dropped_chunks += 1
+        self.dropped_bytes += len(chunk)
+        buf.purge(chunk)
+        return True
+
+    def stats(self):
+        return dict(limit=self.limit, usage=self.usage,
+                    blocked=self.blocked, rejected=self.rejected,
+                    dropped_chunks=self.dropped_chunks,
+                    dropped_bytes=self.dropped_bytes)
+
+MemoryBudget = MemoryBudgetClass()
+
+
+class FlushSchedulerClass(object):
+    u"""
+    すべてのバッファで共有する、ステージ中のチャンクのフラッシュのタイマー.
+
+    チャンクは作られた時に chunk.expire をキーとしてヒープに登録され、
+    1つの greenlet がその時刻に ``buffer.flush_chunk(chunk)`` を呼ぶ.
+    サイズが一杯になって先にキューに入ったチャンクはヒープから削除せず、
+    時刻が来た時に読み飛ばす.
+    """
+
+    #: キューが一杯でフラッシュできなかったチャンクを再試行するまでの秒数
+    retry_interval = 1.0
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = gevent.event.Event()
+        self._greenlet = None
+        self.fired = self.skipped = self.deferred = 0
+
+    def schedule(self, buffer, chunk, at=None):
+        if at is None:
+            at = chunk.expire
+        heap = self._heap
+        heapq.heappush(heap, (at, next(self._seq), buffer, chunk))
+        if heap[0][3] is chunk:
+            # 一番早い時刻が変わったので待ち時間を計算し直させる.
+            self._wakeup.set()
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        heap = self._heap
+        try:
+            while heap:
+                timeout = heap[0][0] - now()
+                if timeout > 0:
+                    self._wakeup.clear()
+                    self._wakeup.wait(timeout)
+                    continue
+                at, _, buffer, chunk = heapq.heappop(heap)
+                try:
+                    buffer.flush_chunk(chunk)
+                except Exception:
+                    log.exception("failed to flush chunk: key=%r", chunk.key)
+                gevent.sleep(0) # give a chance to write.
+        finally:
+            self._greenlet = None
+
+    def stats(self):
+        return dict(pending=len(self._heap), fired=self.fired,
+                    skipped=self.skipped, deferred=self.deferred)
+
+FlushScheduler = FlushSchedulerClass()
+
+
+def worker_path(path):
+    u"""
+    ``--workers`` で複数のワーカーを動かしている時は、ワーカー毎のディレクトリ
+    ``worker<worker_id>`` の下のパスにして、ワーカー同士でファイルを取り合わないようにする.
+    """
+    from fluenpy.engine import Engine
+    if not path or Engine.workers <= 1:
+        return path
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, 'worker%d' % (Engine.worker_id,), basename)
+
+
 class BaseBuffer(Configurable):
 
     buffer_chunk_limit = config_param('size', 128*1024*1024)
     buffer_queue_limit = config_param('integer', 128)
     flush_interval = config_param('time', 60)
 
+    #: 書きこみ待ちキューが一杯の時の動作.
+    #:
+    #: throw_exception
+    #:     ``BufferQueueLimitError`` を送出する. 入力側はこれを見て待つ.
+    #: block
+    #:     キューが空くまで最大 overflow_timeout 秒待ってから送出する.
+    #: drop_oldest_chunk
+    #:     キューの先頭 (一番古い) のチャンクを捨てる.
+    #: spill_to_disk
+    #:     キューに入らないチャンクを spill_path 以下のファイルに書き出し、
+    #:     キューが空いたら順に戻す.
+    overflow_action = config_param('string', 'throw_exception')
+    overflow_timeout = config_param('time', 10)
+    spill_path = config_param('string', None)
+
+    #: 1チャンクのレコード数の上限. 指定しなければ上限なし.
+    buffer_chunk_records_limit = config_param('integer', None)
+
+    #: チャンクに格納する形式. text (そのまま) か gzip.
+    #: buffer_chunk_limit などは圧縮後のサイズに対して適用する.
+    compress = config_param('string', 'text')
+
+    #: チャンクをキューへ移動するタイミング.
+    #:
+    #: interval
+    #:     flush_interval 毎.
+    #: immediate
+    #:     emit 毎. ステージせずにすぐキューに入れる.
+    #: lazy
+    #:     チャンクが一杯になった時と終了時だけ.
+    flush_mode = config_param('string', 'interval')
+    #: 終了時にステージ中のチャンクをキューへ移動して書き出すかどうか.
+    #: 省略するとメモリバッファなら true, 永続化するバッファなら false.
+    flush_at_shutdown = config_param('bool', None)
+
+    OVERFLOW_ACTIONS = ('throw_exception', 'block', 'drop_oldest_chunk', 'spill_to_disk')
+    FLUSH_MODES = ('interval', 'immediate', 'lazy')
+
     _shutdown = False
 
+    #: true ならチャンクをメモリに持つので MemoryBudget で使用量を管理する.
+    in_memory = True
+
+    overflow_count = blocked_count = rejected_count = 0
+    dropped_chunks = dropped_bytes = 0
+    spilled_chunks = spilled_bytes = 0
+
+    def configure(self, conf):
+        super(BaseBuffer, self).configure(conf)
+        if self.overflow_action not in self.OVERFLOW_ACTIONS:
+            raise ConfigError("overflow_action should be one of %s: %r" %
+                              (', '.join(self.OVERFLOW_ACTIONS), self.overflow_action))
+        if self.flush_mode not in self.FLUSH_MODES:
+            raise ConfigError("flush_mode should be one of %s: %r" %
+                              (', '.join(self.FLUSH_MODES), self.flush_mode))
+        if self.flush_at_shutdown is None:
+            self.flush_at_shutdown = self.in_memory
+        if self.compress not in ('text', 'gzip'):
+            raise ConfigError("compress should be text or gzip: %r" % (self.compress,))
+        self._spill = None
+        if self.overflow_action == 'spill_to_disk':
+            if not self.spill_path:
+                raise ConfigError("'spill_path' parameter is required "
+                                  "for overflow_action spill_to_disk")
+            self._spill = Plugin.new_buffer('file')
+            self._spill.configure({'buffer_path': self.spill_path,
+                                   'compress': self.compress})
+
     def new_chunk(self, key, expire):
         raise NotImplemented
 
+    def resume(self):
+        u"""
+        前回終了時に残っていたチャンクを ``(キュー待ちのチャンクのリスト, key => チャンク)``
+        で返す. 永続化するバッファはこれをオーバーライドする.
+        """
+        return [], {}
+
+    def enqueue(self, chunk):
+        u"""*chunk* が書きこみ待ちキューへ移される直前に呼ばれる."""
+        pass
+
     def start(self):
+        queued, self._map = self.resume()
         self._queue = gevent.queue.Queue(self.buffer_queue_limit)
-        self._map = {}
-        gevent.spawn(self.run)
+        self._dequeued = gevent.event.Event()
+        # buffer_queue_limit を超えて受け取ったチャンク. キューが空いたら入れる.
+        # 復元したチャンクも buffer_queue_limit を超えた分はここに置く.
+        self._pending = deque(queued)
+        self._reserving = None
+        self._spilled = deque()
+        if self._spill is not None:
+            # 前回書き出したままのチャンクも戻す.
+            spilled, staged = self._spill.resume()
+            self._spilled.extend(spilled)
+            for chunk in staged.values():
+                self._spill.enqueue(chunk)
+                self._spilled.append(chunk)
+        self._refill()
+        if self.in_memory:
+            MemoryBudget.register(self)
+        for chunk in self._map.values():
+            FlushScheduler.schedule(self, chunk)
+
+    def _create_chunk(self, key, expire):
+        chunk = self.new_chunk(key, expire)
+        if self.compress == 'gzip':
+            chunk.start_compress()
+        return chunk
+
+    def _new_staged_chunk(self, key, expire=None):
+        if expire is None:
+            expire = now() + self.flush_interval
+        chunk = self._create_chunk(key, expire)
+        if self.flush_mode == 'interval':
+            FlushScheduler.schedule(self, chunk)
+        return chunk
 
-    def run(self):
-        # flush を実行する間隔
-        check_interval = min(self.flush_interval/2, 2)
-        while not self._shutdown:
-            gevent.sleep(check_interval)
-            self.flush(force=False)
+    def flush_chunk(self, chunk):
+        u"""
+        *chunk* がまだステージ中ならキューへ移動する. chunk.expire の時刻に
+        ``FlushScheduler`` から呼ばれる.
+        """
+        if self._shutdown or self._map.get(chunk.key) is not chunk:
+            # 既にキューに移動している.
+            FlushScheduler.skipped += 1
+            return
+        try:
+            # 共有の greenlet から呼ばれるので block しない.
+            self._make_room(block=False)
+        except BufferQueueLimitError:
+            log.warn("buffer_queue_limit is exceeded. "
+                     "chunk is kept until next flush: key=%r", chunk.key)
+            FlushScheduler.deferred += 1
+            FlushScheduler.schedule(self, chunk, now() + FlushScheduler.retry_interval)
+            return
+        FlushScheduler.fired += 1
+        del self._map[chunk.key]
+        self._put(chunk)
+
+    def emit(self, key, data, expire=None, records=0, time_range=None,
+             compressed=False):
+        u"""
+        *data* を *key* のチャンクに追記する. *expire* を指定すると
+        新しく作るチャンクは flush_interval ではなくその時刻にフラッシュする.
+        *records* と *time_range* は *data* のレコード数とイベントの時刻の
+        ``(最小値, 最大値)`` で、チャンクのメタデータになる.
+        *compressed* が true なら *data* は gzip で圧縮済みで、
+        ``compress gzip`` のバッファだけが受け取れる.
+        """
+        if compressed and self.compress != 'gzip':
+            raise ValueError("compressed data is emitted to uncompressed buffer")
+        meta = (records,) + tuple(time_range or ())
+        if not self.in_memory:
+            self._emit(key, data, expire, meta, compressed)
+            return
+        # 圧縮後のサイズは分からないので、圧縮前のサイズで確保してから
+        # 余った分を返す.
+        size = len(data)
+        MemoryBudget.acquire(size)
+        try:
+            chunk, stored = self._emit(key, data, expire, meta, compressed)
+        except:
+            MemoryBudget.release(size)
+            raise
+        MemoryBudget.release(size - stored)
+        chunk.accounted += stored
+
+    def _emit(self, key, data, expire=None, meta=(0,), compressed=False):
+        u"""*data* を追記して、追記したチャンクと格納したバイト数を返す."""
+        if self.flush_mode == 'immediate':
+            self._make_room()
+            chunk = self._create_chunk(key, now())
+            try:
+                stored = chunk.append(data, compressed)
+            except:
+                chunk.purge()
+                raise
+            chunk.add_metadata(*meta)
+            self._put(chunk)
+            return chunk, stored
 
-    def emit(self, key, data):
         top = self._map.get(key)
         if not top:
-            top = self._map[key] = self.new_chunk(key, now()+self.flush_interval)
+            top = self._map[key] = self._new_staged_chunk(key, expire)
 
-        if len(top) + len(data) <= self.buffer_chunk_limit:
-            top += data
-            return False
+        # 空のチャンクは上限を超えるデータでもそのまま受け取る.
+        records_limit = self.buffer_chunk_records_limit
+        if not len(top) or (len(top) + len(data) <= self.buffer_chunk_limit and
+                            (not records_limit or
+                             top.records + meta[0] <= records_limit)):
+            stored = top.append(data, compressed)
+            top.add_metadata(*meta)
+            return top, stored
 
         if len(data) > self.buffer_chunk_limit:
             log.warn("Size of the emitted data exceeds buffer_chunk_limit.\n"
@@ -86,45 +572,242 @@ class BaseBuffer(Configurable):
                      "in the forward output ``at the log forwarding server.``"
                      )
 
-        nc = self.new_chunk(key, now()+self.flush_interval)
+        # 空きを作れなければ data を受け取らずに呼び出し元に返す.
+        self._make_room()
 
+        nc = self._new_staged_chunk(key, top.expire if expire is not None else None)
         try:
-            nc += data
-            self._map[key] = nc
-            self._queue.put_nowait(top)
-        except gqueue.Full:
-            log.error("buffer_queue_limit is exceeded.")
+            stored = nc.append(data, compressed)
         except:
             nc.purge()
             raise
+        nc.add_metadata(*meta)
+        self._put(top)
+        self._map[key] = nc
+        return nc, stored
+
+    def _free_slots(self):
+        return self._queue.maxsize - self._queue.qsize() - len(self._pending)
+
+    def _make_room(self, block=True, n=1):
+        u"""
+        キューの空きが *n* 個より少なければ overflow_action に従って空きを作る.
+        空きを作れなければ ``BufferQueueLimitError`` を送出する.
+        *block* が false なら overflow_action が block でも待たない.
+        """
+        if self._free_slots() >= n or self._reserving is gevent.getcurrent():
+            return
+        self.overflow_count += 1
+        action = self.overflow_action
+        if action == 'spill_to_disk':
+            return
+        if action == 'drop_oldest_chunk':
+            while self._free_slots() < n and not self._queue.empty():
+                chunk = self.get_nowait()
+                log.warn("buffer_queue_limit is exceeded. dropping the oldest chunk: "
+                         "key=%r size=%d", chunk.key, len(chunk))
+                self.dropped_chunks += 1
+                self.dropped_bytes += len(chunk)
+                self.purge(chunk)
+            if self._free_slots() >= n:
+                return
+        if action == 'block' and block and n <= self._queue.maxsize:
+            self.blocked_count += 1
+            deadline = now() + self.overflow_timeout
+            while self._free_slots() < n:
+                timeout = deadline - now()
+                if timeout <= 0:
+                    break
+                self._dequeued.clear()
+                self._dequeued.wait(timeout)
+            if self._free_slots() >= n:
+                return
+        self.rejected_count += 1
+        raise BufferQueueLimitError("buffer_queue_limit is exceeded.")
+
+    def _chunks_needed(self, items):
+        u"""*items* を ``emit`` した時にキューに入るチャンクの数を見積もる."""
+        if self.flush_mode == 'immediate':
+            return len(items)
+        records_limit = self.buffer_chunk_records_limit
+        state = {}
+        n = 0
+        for key, data, expire, records, time_range, compressed in items:
+            if key not in state:
+                top = self._map.get(key)
+                state[key] = (len(top), top.records) if top else (0, 0)
+            size, recs = state[key]
+            if not size or (size + len(data) <= self.buffer_chunk_limit and
+                            (not records_limit or recs + records <= records_limit)):
+                state[key] = (size + len(data), recs + records)
+            else:
+                n += 1
+                state[key] = (len(data), records)
+        return n
+
+    def emit_all(self, items):
+        u"""
+        ``(key, data, expire, records, time_range, compressed)`` のリストを
+        ``emit`` する. キューとメモリの上限に収まらなければ、どれも格納せずに
+        ``error.BufferError`` を送出するので、呼び出し元は全体を emit しなおせる.
+        buffer_queue_limit より多くのチャンクになる場合は、キューを空にできれば
+        受け取り、入りきらないチャンクはキューが空くまで取っておく.
+        """
+        if len(items) <= 1:
+            for item in items:
+                self.emit(*item)
+            return
+        self._make_room(n=min(self._chunks_needed(items), self._queue.maxsize))
+        if self.in_memory:
+            size = sum(len(item[1]) for item in items)
+            MemoryBudget.acquire(size)
+            MemoryBudget.release(size)
+        # 空きは確保したので、途中のチャンクで BufferQueueLimitError にしない.
+        self._reserving = gevent.getcurrent()
+        try:
+            for item in items:
+                self.emit(*item)
+        finally:
+            self._reserving = None
+
+    def check_room(self, items):
+        u"""
+        *items* を ``emit_all`` で受け取れるかを調べる. 受け取れなければ
+        ``emit_all`` と同じ ``error.BufferError`` を送出する.
+        overflow_action が drop_oldest_chunk ならチャンクを捨てずに受け取れるとみなす.
+        """
+        if self.overflow_action != 'drop_oldest_chunk':
+            self._make_room(n=min(self._chunks_needed(items), self._queue.maxsize))
+        if self.in_memory and MemoryBudget.policy != 'drop_oldest':
+            size = sum(len(item[1]) for item in items)
+            MemoryBudget.acquire(size)
+            MemoryBudget.release(size)
+
+    def _put(self, chunk):
+        u"""*chunk* をキューに入れる. 入らなければディスクに書き出す."""
+        chunk.finish()
+        if self._spill is not None and (self._spilled or self._queue.full()):
+            # キューの順序を保つため、書き出したチャンクが残っている間は
+            # 新しいチャンクも書き出す.
+            self._spilled.append(self._spill_chunk(chunk))
+            return
+        self.enqueue(chunk)
+        if self._queue.full():
+            self._pending.append(chunk)
+        else:
+            self._queue.put_nowait(chunk)
+
+    def _spill_chunk(self, chunk):
+        u"""*chunk* をディスクのチャンクにコピーして破棄し、コピーを返す."""
+        chunk.finish()
+        sc = self._spill.new_chunk(chunk.key, chunk.expire)
+        sc.compressed = chunk.compressed
+        for segment in chunk.raw_segments():
+            sc += segment
+        sc.add_metadata(chunk.records, chunk.first_time, chunk.last_time)
+        self._spill.enqueue(sc)
+        self.spilled_chunks += 1
+        self.spilled_bytes += len(sc)
+        self.purge(chunk)
+        return sc
+
+    def _refill(self):
+        for waiting in (self._pending, self._spilled):
+            while waiting and not self._queue.full():
+                self._queue.put_nowait(waiting.popleft())
+
+    def _dequeue(self, chunk):
+        self._refill()
+        self._dequeued.set()
+        return chunk
 
     def keys(self):
         return self._map.keys()
 
-    def flush(self, force=True):
-        u"""バッファリング中のチャンクを書きこみ待ちキューへ移動する.
-        *force* が true のときはすべてのチャンクを移動し、 false の時は
-        chunk.expire が古いものだけをフラッシュする.
+    def flush(self, deadline=None):
+        u"""バッファリング中のすべてのチャンクを書きこみ待ちキューへ移動する.
+        chunk.expire が来たチャンクは ``FlushScheduler`` が個別に移動する.
+        キューが一杯なら空くまで待つ. *deadline* までに空かなければ
+        残りのチャンクはステージに残す.
         """
         map_ = self._map
         keys = list(map_.keys())
-        t = now()
         for key in keys:
             chunk = map_[key]
-            if not force and chunk.expire > t:
-                continue
+            # 捨てずに書き出されるのを待つ.
+            while self._free_slots() <= 0 and self._spill is None:
+                timeout = 1 if deadline is None else deadline - now()
+                if timeout <= 0:
+                    return
+                self._dequeued.clear()
+                self._dequeued.wait(timeout)
             del map_[key]
-            self._queue.put(chunk) # Would block here.
+            self._put(chunk)
             gevent.sleep(0) # give a chance to write.
         if keys:
             log.debug("flush: queue size=%s", self._queue.qsize())
 
+    def metrics(self):
+        queued = list(self._queue.queue) + list(self._pending)
+        staged = list(self._map.values())
+        return dict(buffer_queue_length=len(queued),
+                    buffer_stage_length=len(staged),
+                    buffer_spill_length=len(self._spilled),
+                    buffer_total_bytes=sum(map(len, queued)) + sum(map(len, staged)),
+                    buffer_overflow_count=self.overflow_count,
+                    buffer_blocked_count=self.blocked_count,
+                    buffer_rejected_count=self.rejected_count,
+                    buffer_dropped_chunks=self.dropped_chunks,
+                    buffer_dropped_bytes=self.dropped_bytes,
+                    buffer_spilled_chunks=self.spilled_chunks,
+                    buffer_spilled_bytes=self.spilled_bytes)
+
     def get(self, block=True, timeout=None):
-        return self._queue.get(block, timeout)
+        return self._dequeue(self._queue.get(block, timeout))
+
+    def peek(self):
+        u"""キューの先頭のチャンクを取り出さずに返す. 空なら None."""
+        try:
+            return self._queue.peek_nowait()
+        except gevent.queue.Empty:
+            return None
+
+    def purge(self, chunk):
+        u"""書き出し終わった、または捨てる *chunk* を破棄する."""
+        MemoryBudget.release(chunk.accounted)
+        chunk.accounted = 0
+        chunk.purge()
 
     def get_nowait(self):
-        return self._queue.get_nowait()
+        return self._dequeue(self._queue.get_nowait())
 
-    def shutdown(self):
+    def shutdown(self, deadline=None):
         self._shutdown = True
-        self.flush()
+        if self.flush_at_shutdown:
+            self.flush(deadline)
+
+    def remaining_chunks(self):
+        u"""キューとステージに残っているメモリ上のチャンクを順に返す."""
+        spilled = set(map(id, self._spilled))
+        return ([c for c in self._queue.queue if id(c) not in spilled] +
+                list(self._pending) +
+                list(self._map.values()))
+
+    def close(self, unsent=()):
+        u"""
+        出力の終了時に呼ばれる. *unsent* は書き出しに失敗したチャンク.
+        spill_to_disk なら残っているチャンクをディスクに書き出して次回に
+        書き出す. そうでなければ捨てる. 永続化するバッファはオーバーライドする.
+        """
+        chunks = list(unsent) + self.remaining_chunks()
+        if not chunks:
+            return
+        if self._spill is not None:
+            for chunk in chunks:
+                self._spill_chunk(chunk)
+            log.info("spilled %d chunks at shutdown", len(chunks))
+            return
+        log.error("%d chunks (%d bytes) are not written and lost at shutdown",
+                  len(chunks), sum(map(len, chunks)))
+        for chunk in chunks:
+            self.purge(chunk)
@@ -0,0 +1,74 @@
+# coding: utf-8
+"""
+    fluenpy.cache
+    ~~~~~~~~~~~~~
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+
+
+class ClockCache(object):
+    u"""
+    CLOCK アルゴリズムで LRU を近似する、サイズ上限付きのキャッシュ.
+
+    ヒット時は参照ビットを立てるだけなので、OrderedDict で並べ替えるより軽い.
+    ``hits``, ``misses``, ``evictions`` は ``clear()`` してもリセットされない.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = self.misses = self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self._index = {}
+        self._keys = []
+        self._values = []
+        self._ref = []
+        self._hand = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key, default=None):
+        idx = self._index.get(key)
+        if idx is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._ref[idx] = True
+        return self._values[idx]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        idx = self._index.get(key)
+        if idx is not None:
+            self._values[idx] = value
+            self._ref[idx] = True
+            return
+        if len(self._keys) < self.capacity:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._values.append(value)
+            self._ref.append(False)
+            return
+
+        ref = self._ref
+        hand = self._hand
+        while ref[hand]:
+            ref[hand] = False
+            hand = (hand + 1) % self.capacity
+        del self._index[self._keys[hand]]
+        self.evictions += 1
+        self._index[key] = hand
+        self._keys[hand] = key
+        self._values[hand] = value
+        self._hand = (hand + 1) % self.capacity
+
+    def stats(self):
+        return dict(size=len(self), capacity=self.capacity,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
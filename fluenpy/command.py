@@ -24,6 +24,9 @@ def make_parser():
     option('-c', '--config', default=DEFAULT_CONFIG_PATH,
            help="config file path"
            )
+    option('-w', '--workers', type='int', default=1,
+           help="number of engine processes"
+           )
     option('-v', '--verbose', action="count", default=0)
     option('-q', '--quiet', action="store_true")
     return parser
@@ -39,6 +39,17 @@ class Element(dict):
         self.used.add(k)
         return dict.get(self, k, D)
 
+    def config_key(self, with_arg=True):
+        u"""設定内容が同じ要素同士で等しくなる hashable な値を返す."""
+        return (self.name, self.arg if with_arg else None,
+                tuple(sorted(dict.items(self))),
+                tuple(e.config_key() for e in self.elements))
+
+    def mark_used(self):
+        self.used.update(dict.keys(self))
+        for e in self.elements:
+            e.mark_used()
+
     def not_fetched(self):
         ret = []
         for key in self:
@@ -11,9 +11,15 @@ from __future__ import print_function, division, absolute_import, with_statement
 import logging
 import os
 
-from fluenpy.match import Match, NoMatch
+from fluenpy.match import Match, MatchTrie, NoMatch
 from fluenpy.plugin import Plugin
+from fluenpy.buffer import FlushScheduler, MemoryBudget
+from fluenpy.cache import ClockCache
+from fluenpy.event import EventStream, ArrayEventStream, OneEventStream
+from fluenpy.filter import FilterChain
 from fluenpy import config
+from fluenpy.config import Configurable, config_param
+from fluenpy import error
 from fluenpy.error import ConfigError
 import gevent
 import signal
@@ -25,22 +31,81 @@ _sighandlers_set = False
 def shutdown_handler(sig, frame):
     Engine.shutdown()
 
+def reload_handler(sig, frame):
+    Engine.request_reload()
+
 def set_sighandlers():
     global _sighandlers_set
     if not _sighandlers_set:
         for sig in (signal.SIGABRT, signal.SIGINT, signal.SIGTERM):
             signal.signal(sig, shutdown_handler)
+        signal.signal(signal.SIGHUP, reload_handler)
         _sighandlers_set = True
 
+class SystemConfig(Configurable):
+    u"""``<system>`` ディレクティブで指定するプロセス全体の設定."""
+
+    #: tag => match のキャッシュに保持する tag の数. 0 でキャッシュしない.
+    match_cache_size = config_param('integer', 1024)
+
+    #: すべての出力のメモリバッファの合計サイズの上限. 0 なら上限なし.
+    total_limit_size = config_param('size', 0)
+    #: 上限に達した時の動作. block, drop_oldest, reject のいずれか.
+    total_limit_policy = config_param('string', 'block')
+    #: total_limit_policy が block の時に待つ最大の時間.
+    total_limit_block_timeout = config_param('time', 10)
+
+
+class _Routes(object):
+    u"""設定ファイルから組み立てた system, source, filter, match の一式."""
+
+    def __init__(self, system=None):
+        if system is None:
+            system = SystemConfig()
+            system.configure({})
+        self.system = system
+        self.sources = []
+        # フィルタも pattern でマッチするので Match でラップして保持する.
+        self.filters = []
+        self.filter_bounds = []     # そのフィルタより前に定義された <match> の数
+        self.matches = []
+
+    def plugins(self):
+        return ([('input', s) for s in self.sources] +
+                [('filter', f.output) for f in self.filters] +
+                [('output', m.output) for m in self.matches])
+
+
 class EngineClass(object):
     def __init__(self):
-        self._matches = []
-        self._sources = []
-        self._match_cache = {}
+        # Supervisor が複数のワーカーを fork したときに設定される.
+        self.worker_id = 0
+        self.workers = 1
+        self._config_path = None
+        self._routes = _Routes()
+        self.system = self._routes.system
+        self._match_trie = MatchTrie([])
+        self._filter_trie = MatchTrie([])
+        self._match_cache = ClockCache(self.system.match_cache_size)
         self._started = []
         self._shutdown = False
+        self._reload_requested = False
+        self.emit_count = self.emit_records = 0
+
+    @property
+    def _sources(self):
+        return self._routes.sources
+
+    @property
+    def _filters(self):
+        return self._routes.filters
+
+    @property
+    def _matches(self):
+        return self._routes.matches
 
     def read_config(self, path):
+        self._config_path = path
         with open(path) as f:
             self.parse_config(f, os.path.basename(path), os.path.dirname(path))
 
@@ -50,16 +115,36 @@ class EngineClass(object):
         for elem, key in conf.not_fetched():
             log.warn("parameter %r in %s is not used.", key, elem)
 
-    def _config_source(self, elem):
+    def _new_plugin(self, new, elem, reusable, key):
+        u"""
+        設定が変わっていないプラグインが *reusable* にあればそれを返す.
+        無ければ新しく作る. 2番目の戻り値は再利用したかどうか.
+        """
+        candidates = reusable.get(key)
+        if candidates:
+            elem.mark_used()
+            return candidates.pop(0), True
+        plugin = new(elem['type'])
+        plugin._config_key = key
+        return plugin, False
+
+    def _config_source(self, elem, routes, reusable):
         type = elem['type']
         if not type:
             raise ConfigError("Missing 'type' parameter on <source> directive")
-        log.info("adding source type=%r", type)
-        in_ = Plugin.new_input(type)
-        in_.configure(elem)
-        self._sources.append(in_)
+        in_, reused = self._new_plugin(Plugin.new_input, elem, reusable,
+                                       elem.config_key())
+        if self.worker_id != 0 and not in_.multi_workers:
+            log.info("source type=%r runs only on worker 0", type)
+            # 使わない設定について警告しない.
+            elem.mark_used()
+            return
+        if not reused:
+            log.info("adding source type=%r", type)
+            in_.configure(elem)
+        routes.sources.append(in_)
 
-    def _config_match(self, elem):
+    def _config_match(self, elem, routes, reusable):
         type = elem['type']
         pattern = elem.arg
         if not type:
@@ -68,39 +153,207 @@ class EngineClass(object):
                     pattern)
         log.info("adding match %r => %r", pattern, type)
 
-        out = Plugin.new_output(type)
-        out.configure(elem)
+        out, reused = self._new_plugin(Plugin.new_output, elem, reusable,
+                                       elem.config_key(with_arg=False))
+        if not reused:
+            out.configure(elem)
         match = Match(pattern, out)
-        self._matches.append(match)
+        routes.matches.append(match)
 
-    def configure(self, conf):
+    def _config_filter(self, elem, routes, reusable):
+        type = elem['type']
+        pattern = elem.arg
+        if not type:
+            raise ConfigError(
+                    "Missing 'type' parameter on <filter %s> directive" %
+                    (pattern,))
+        log.info("adding filter %r => %r", pattern, type)
+
+        filter, reused = self._new_plugin(Plugin.new_filter, elem, reusable,
+                                          elem.config_key(with_arg=False))
+        if not reused:
+            filter.configure(elem)
+        routes.filters.append(Match(pattern, filter))
+        routes.filter_bounds.append(len(routes.matches))
+
+    def _config_system(self, elem):
+        u"""``<system>`` を読む. 設定を反映するのは ``_swap`` で行う."""
+        system = SystemConfig()
+        system.configure(elem)
+        if system.total_limit_policy not in MemoryBudget.POLICIES:
+            raise ConfigError("total_limit_policy should be one of %s: %r" %
+                              (', '.join(MemoryBudget.POLICIES),
+                               system.total_limit_policy))
+        return system
+
+    def _apply_system(self, system):
+        self.system = system
+        self._match_cache.capacity = system.match_cache_size
+        MemoryBudget.configure(system.total_limit_size,
+                               system.total_limit_policy,
+                               system.total_limit_block_timeout)
+
+    def _build(self, conf):
+        u"""
+        *conf* から新しい ``_Routes`` を作る. 現在の構成と設定が同じ
+        プラグインは作り直さずに再利用するので、バッファやソケットは引き継がれる.
+        """
         Plugin.load_plugins()
+        reusable = {}
+        for category, plugin in self._routes.plugins():
+            key = getattr(plugin, '_config_key', None)
+            reusable.setdefault(key, []).append(plugin)
+
+        system = None
+        for elem in conf.elements:
+            if elem.name == 'system':
+                system = self._config_system(elem)
+        routes = _Routes(system)
         for elem in conf.elements:
             if elem.name == 'source':
-                self._config_source(elem)
+                self._config_source(elem, routes, reusable)
+            elif elem.name == 'filter':
+                self._config_filter(elem, routes, reusable)
             elif elem.name == 'match':
-                self._config_match(elem)
+                self._config_match(elem, routes, reusable)
+        return routes
+
+    def _swap(self, routes):
+        # この間に他の greenlet に切り替わらないので、emit からは新旧どちらかの
+        # 構成だけが見える.
+        self._apply_system(routes.system)
+        self._routes = routes
+        self._match_trie = MatchTrie(routes.matches)
+        self._filter_trie = MatchTrie(routes.filters)
+        self._match_cache.clear()
+
+    def configure(self, conf):
+        self._swap(self._build(conf))
+
+    def request_reload(self):
+        self._reload_requested = True
+
+    def reload(self):
+        u"""
+        設定ファイルを読み直して、新しい構成に切り替える.
+        設定が変わっていないプラグインはそのまま使い続け、
+        削除された出力はバッファを書き出してから終了する.
+        """
+        if not self._config_path:
+            log.warn("reload is requested but config file is not given.")
+            return
+        log.info("reloading config file: %s", self._config_path)
+        old = self._routes
+        try:
+            conf = config.read(self._config_path)
+            new = self._build(conf)
+        except Exception:
+            log.exception("failed to reload config. continue with current config.")
+            return
+        for elem, key in conf.not_fetched():
+            log.warn("parameter %r in %s is not used.", key, elem)
+
+        old_ids = set(id(p) for c, p in old.plugins())
+        new_ids = set(id(p) for c, p in new.plugins())
+        added = [(c, p) for c, p in new.plugins() if id(p) not in old_ids]
+        removed = [(c, p) for c, p in old.plugins() if id(p) not in new_ids]
+
+        started = []
+        stopped = []
+        try:
+            for category, plugin in added:
+                if category != 'input':
+                    plugin.start()
+                    started.append(plugin)
+            self._swap(new)
+            for category, plugin in removed:
+                if category == 'input':
+                    plugin.shutdown()
+                    stopped.append(plugin)
+            for category, plugin in added:
+                if category == 'input':
+                    plugin.start()
+                    started.append(plugin)
+        except Exception:
+            log.exception("failed to start new plugins. continue with current config.")
+            self._rollback(old, started, stopped)
+            return
+
+        for category, plugin in removed:
+            if category != 'input':
+                # 書き出しが終わるまで時間がかかるので別の greenlet で行う.
+                gevent.spawn(plugin.shutdown)
+        log.info("reloaded: %d plugins added, %d plugins removed.",
+                 len(added), len(removed))
+
+    def _rollback(self, old, started, stopped):
+        u"""reload の途中で失敗した時に、*old* の構成に戻す."""
+        for plugin in reversed(started):
+            try:
+                plugin.shutdown()
+            except Exception:
+                log.exception("failed to shutdown %r", plugin)
+        self._swap(old)
+        for plugin in stopped:
+            try:
+                plugin.start()
+            except Exception:
+                log.exception("failed to restart %r", plugin)
 
     def emit(self, tag, time, record):
-        self.emit_stream(tag, [(time, record)])
+        self.emit_stream(tag, OneEventStream(time, record))
 
-    def emit_stream(self, tag, array):
+    def emit_stream(self, tag, es):
+        if not isinstance(es, EventStream):
+            es = ArrayEventStream(list(es))
         try:
-            target = self._match_cache.get(tag, None)
+            target = self._match_cache.get(tag)
             if target is None:
-                target = self.match(tag) or NoMatch.instance
-                if len(self._match_cache) < 1024:
-                    self._match_cache[tag] = target
-            target.emit(tag, array)
+                target = self.route(tag)
+                self._match_cache.put(tag, target)
+            target.emit(tag, es)
+            self.emit_count += 1
+            self.emit_records += len(es)
+        except error.BufferError:
+            # バックプレッシャーは入力側で処理する.
+            raise
         except Exception as e:
             log.warn("emit transaction failed. error=%s", e)
             raise
 
     def match(self, tag):
-        for m in self._matches:
-            if m.match(tag):
-                return m
-        return None
+        return self._match_trie.match(tag)
+
+    def route(self, tag):
+        u"""
+        *tag* の emit 先を返す. <match> より前に定義された <filter> のうち
+        *tag* にマッチするものがあれば、それらを定義順に通す ``FilterChain`` を返す.
+        """
+        routes = self._routes
+        idx = self._match_trie.match_index(tag)
+        if idx is None:
+            return NoMatch.instance
+        target = routes.matches[idx]
+        filters = [routes.filters[i].output
+                   for i in self._filter_trie.match_all(tag)
+                   if routes.filter_bounds[i] <= idx]
+        if filters:
+            return FilterChain(filters, target)
+        return target
+
+    def match_cache_stats(self):
+        return self._match_cache.stats()
+
+    def plugins(self):
+        u"""``(種類, プラグイン)`` のリストを返す. 種類は input, filter, output のいずれか."""
+        return self._routes.plugins()
+
+    def metrics(self):
+        return dict(emit_count=self.emit_count,
+                    emit_records=self.emit_records,
+                    match_cache=self.match_cache_stats(),
+                    buffer_budget=MemoryBudget.stats(),
+                    flush_scheduler=FlushScheduler.stats())
 
     def shutdown(self):
         self._shutdown = True
@@ -109,15 +362,22 @@ class EngineClass(object):
         set_sighandlers()
         for m in self._matches:
             m.start()
+        for f in self._filters:
+            f.start()
         for s in self._sources:
             s.start()
 
         while not self._shutdown:
             gevent.sleep(1)
+            if self._reload_requested:
+                self._reload_requested = False
+                self.reload()
 
         for s in self._sources:
             s.shutdown()
-        for m in self._matches:
-            m.shutdown()
+        for f in self._filters:
+            f.shutdown()
+        # 出力は残っているチャンクを書き出すので並行して終了する.
+        gevent.joinall([gevent.spawn(m.shutdown) for m in self._matches])
 
 Engine = EngineClass()
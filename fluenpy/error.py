@@ -14,3 +14,6 @@ class BufferChunkLimitError(BufferError):
 class BufferQueueLimitError(BufferError):
     pass
 
+class BufferTotalLimitError(BufferError):
+    pass
+
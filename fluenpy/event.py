@@ -0,0 +1,210 @@
+# coding: utf-8
+"""
+    fluenpy.event
+    ~~~~~~~~~~~~~
+
+    Event streams passed from inputs to outputs.
+
+    An event stream is a repeatable sequence of ``(time, record)`` pairs.
+    ``to_mpac()`` returns the events packed with msgpack and caches the
+    result, so a stream is packed at most once, however many outputs
+    receive it.
+
+    Times packed as the forward protocol's EventTime ext type are decoded
+    to float by ``ext_hook``.
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+
+import msgpack
+import struct
+from io import BytesIO
+from msgpack import Unpacker
+
+from fluenpy.buffer import GzipReader
+
+__all__ = ['EventStream', 'ArrayEventStream', 'OneEventStream',
+           'MessagePackEventStream', 'CompressedMessagePackEventStream',
+           'ext_hook']
+
+#: forward プロトコルの EventTime の ext type
+EVENT_TIME_EXT = 0
+
+
+def ext_hook(code, data):
+    u"""EventTime (秒とナノ秒の組) を float にする. Unpacker の ext_hook に渡す."""
+    if code == EVENT_TIME_EXT and len(data) == 8:
+        sec, nsec = struct.unpack('!LL', data)
+        return sec + nsec / 1e9
+    return msgpack.ExtType(code, data)
+
+
+class EventStream(object):
+    _mpac = None
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        raise NotImplementedError
+
+    def __getitem__(self, index):
+        u"""スライスを渡すと ``EventStream`` を、整数を渡すとイベントを返す."""
+        raise NotImplementedError
+
+    def time_range(self):
+        u"""イベントの時刻の ``(最小値, 最大値)`` を返す. 空なら ``(None, None)``."""
+        times = [t for t, r in self]
+        if not times:
+            return None, None
+        return min(times), max(times)
+
+    def _pack(self):
+        packer = msgpack.Packer()
+        return b''.join([packer.pack(e) for e in self])
+
+    def to_mpac(self):
+        u"""msgpack でシリアライズしたイベントを返す. 結果はキャッシュされる."""
+        if self._mpac is None:
+            self._mpac = self._pack()
+        return self._mpac
+
+
+class ArrayEventStream(EventStream):
+    def __init__(self, entries):
+        self._entries = entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ArrayEventStream(self._entries[index])
+        return self._entries[index]
+
+
+class OneEventStream(EventStream):
+    def __init__(self, time, record):
+        self.time = time
+        self.record = record
+
+    def __len__(self):
+        return 1
+
+    def __iter__(self):
+        yield self.time, self.record
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ArrayEventStream([(self.time, self.record)][index])
+        return [(self.time, self.record)][index]
+
+    def time_range(self):
+        return self.time, self.time
+
+    def _pack(self):
+        return msgpack.packb((self.time, self.record))
+
+
+class MessagePackEventStream(EventStream):
+    u"""msgpack でシリアライズされたままのイベント列.
+
+    *size* はイベント数で、分かっていれば ``__len__`` がデータを走査しない.
+    """
+
+    def __init__(self, data, size=None):
+        self._mpac = data
+        self._size = size
+        self._entries = None
+        self._time_range = None
+
+    def _unpacker(self):
+        unp = Unpacker(ext_hook=ext_hook)
+        unp.feed(self._mpac)
+        return unp
+
+    def __len__(self):
+        if self._size is None:
+            if self._entries is not None:
+                self._size = len(self._entries)
+            else:
+                unp = self._unpacker()
+                n = 0
+                while 1:
+                    try:
+                        unp.skip()
+                    except msgpack.OutOfData:
+                        break
+                    n += 1
+                self._size = n
+        return self._size
+
+    def __iter__(self):
+        if self._entries is not None:
+            return iter(self._entries)
+        return iter(self._unpacker())
+
+    def time_range(self):
+        if self._time_range is None:
+            if self._entries is not None:
+                self._time_range = super(MessagePackEventStream, self).time_range()
+            else:
+                # レコードはデコードせずに読み飛ばす.
+                unp = self._unpacker()
+                first = last = None
+                n = 0
+                while 1:
+                    try:
+                        unp.read_array_header()
+                    except msgpack.OutOfData:
+                        break
+                    t = unp.unpack()
+                    unp.skip()
+                    n += 1
+                    if first is None or t < first:
+                        first = t
+                    if last is None or t > last:
+                        last = t
+                self._size = n
+                self._time_range = (first, last)
+        return self._time_range
+
+    def __getitem__(self, index):
+        if self._entries is None:
+            self._entries = list(self._unpacker())
+        if isinstance(index, slice):
+            return ArrayEventStream(self._entries[index])
+        return self._entries[index]
+
+    def to_mpac(self):
+        return self._mpac
+
+
+class CompressedMessagePackEventStream(MessagePackEventStream):
+    u"""gzip で圧縮された msgpack のイベント列. 少しずつ伸長しながら読む.
+
+    ``compressed_mpac()`` は圧縮したままのデータを返すので、
+    圧縮するバッファにはそのまま格納できる.
+    """
+
+    def __init__(self, data, size=None):
+        super(CompressedMessagePackEventStream, self).__init__(None, size)
+        self._compressed = data
+
+    def _unpacker(self):
+        if self._mpac is not None:
+            return super(CompressedMessagePackEventStream, self)._unpacker()
+        return Unpacker(GzipReader(BytesIO(self._compressed)), ext_hook=ext_hook)
+
+    def compressed_mpac(self):
+        return self._compressed
+
+    def to_mpac(self):
+        if self._mpac is None:
+            self._mpac = GzipReader(BytesIO(self._compressed)).read()
+        return self._mpac
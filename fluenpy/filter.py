@@ -0,0 +1,62 @@
+# coding: utf-8
+"""
+    fluenpy.filter
+    ~~~~~~~~~~~~~~
+
+    Base class for filter plugins.
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+import logging
+log = logging.getLogger(__name__)
+
+from fluenpy.config import Configurable
+from fluenpy.event import ArrayEventStream
+
+
+class Filter(Configurable):
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def metrics(self):
+        return {}
+
+    def filter(self, tag, time, record):
+        u"""変換したレコードを返す. None を返すとそのイベントは捨てられる."""
+        return record
+
+    def filter_stream(self, tag, es):
+        u"""
+        イベントストリーム *es* を受け取り、フィルタ後のストリームを返す.
+        バッチ単位で処理したいプラグインはこのメソッドをオーバーライドする.
+        """
+        filter = self.filter
+        entries = []
+        for time, record in es:
+            record = filter(tag, time, record)
+            if record is not None:
+                entries.append((time, record))
+        return ArrayEventStream(entries)
+
+
+class FilterChain(object):
+    u"""
+    tag 毎にコンパイルされたフィルタの列と、その後に続く出力先.
+    ``Engine.emit_stream`` は ``Match`` の代わりにこれを emit 先に使う.
+    """
+
+    def __init__(self, filters, target):
+        self.filters = filters
+        self.target = target
+
+    def emit(self, tag, es):
+        for f in self.filters:
+            es = f.filter_stream(tag, es)
+            if not len(es):
+                return
+        self.target.emit(tag, es)
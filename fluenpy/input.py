@@ -12,14 +12,78 @@
 from __future__ import print_function, division, absolute_import, with_statement
 import logging
 import os
+import sys
 
+import gevent
+import gevent.socket as socket
+from fluenpy import error
 from fluenpy.config import Configurable
+from fluenpy.engine import Engine
 
 log = logging.getLogger(__name__)
 
+# Python 2 の socket モジュールには SO_REUSEPORT が無い.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
+
+def bind_socket(address, type=socket.SOCK_STREAM, reuse_port=False, backlog=256):
+    u"""*address* に bind したソケットを返す. TCP の場合は listen もする.
+
+    *reuse_port* が true の時は SO_REUSEPORT を設定し、複数のワーカープロセスが
+    同じポートで待ち受けられるようにする.
+    """
+    sock = socket.socket(socket.AF_INET, type)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    if type == socket.SOCK_STREAM:
+        sock.listen(backlog)
+    return sock
+
+
 class Input(Configurable):
+
+    #: true ならワーカープロセス毎に起動する. false の時はワーカー 0 でだけ起動する.
+    multi_workers = False
+
+    #: 出力のバッファが一杯の時に emit をリトライする間隔 (秒). 失敗する度に倍になる.
+    backpressure_wait = 0.1
+    backpressure_max_wait = 5.0
+
     def start(self):
         pass
 
     def shutdown(self):
         pass
+
+    emit_count = emit_records = bytes_in = 0
+
+    def metrics(self):
+        return dict(emit_count=self.emit_count,
+                    emit_records=self.emit_records,
+                    bytes_in=self.bytes_in)
+
+    def emit_stream(self, tag, es, block=True):
+        u"""
+        ``Engine.emit_stream`` を呼ぶ. 出力のバッファが一杯なら空くまで待つので、
+        呼び出し元の読み込みもその間止まる.
+        *block* が false の時は待たずに ``error.BufferError`` を送出する.
+        """
+        wait = self.backpressure_wait
+        while 1:
+            try:
+                Engine.emit_stream(tag, es)
+                self.emit_count += 1
+                self.emit_records += len(es)
+                return
+            except error.BufferError as e:
+                if not block:
+                    raise
+                if wait == self.backpressure_wait:
+                    log.warn("buffer is full. waiting to emit: tag=%s error=%s", tag, e)
+                gevent.sleep(wait)
+                wait = min(wait * 2, self.backpressure_max_wait)
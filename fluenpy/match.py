@@ -3,6 +3,10 @@
     fluenpy.match
     ~~~~~~~~~~~~~~
 
+    Tag patterns follow fluentd: tags are split by ``.`` into segments,
+    ``*`` matches exactly one segment, ``**`` matches zero or more segments
+    and ``?``/``[...]`` may be used inside a segment.
+
     :copyright: (c) 2012 by INADA Naoki
     :license: Apache v2
 """
@@ -11,24 +15,73 @@ import logging
 log = logging.getLogger(__name__)
 
 import re
-import fnmatch
+from time import time as now
+
+
+def _translate_segment(seg):
+    u"""1セグメント分のパターンを正規表現に変換する."""
+    i, n = 0, len(seg)
+    res = []
+    while i < n:
+        c = seg[i]
+        i += 1
+        if c == '*':
+            res.append('[^.]*')
+        elif c == '?':
+            res.append('[^.]')
+        elif c == '[':
+            j = i
+            if j < n and seg[j] == '!':
+                j += 1
+            if j < n and seg[j] == ']':
+                j += 1
+            while j < n and seg[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+                continue
+            stuff = seg[i:j].replace('\\', '\\\\')
+            i = j + 1
+            if stuff[:1] == '!':
+                stuff = '^' + stuff[1:]
+            elif stuff[:1] == '^':
+                stuff = '\\' + stuff
+            res.append('[%s]' % (stuff,))
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+
+def _translate(pattern):
+    u"""パターンを ``tag + '.'`` に対してマッチする正規表現に変換する."""
+    res = []
+    for seg in pattern.split('.'):
+        if seg == '**':
+            res.append('(?:[^.]*\\.)*')
+        else:
+            res.append(_translate_segment(seg) + '\\.')
+    return ''.join(res)
 
 
 class Match(object):
     def __init__(self, pattern, output):
         self.output = output
+        self.patterns = pattern.split()
 
-        patterns = pattern.split()
-        rex = map(fnmatch.translate, pattern.split())
-        rex = ')|('.join(rex)
+        rex = ')|('.join(map(_translate, self.patterns))
         rex = '\\A((' + rex + '))\\Z'
         self._rex = re.compile(rex)
 
     def match(self, tag):
-        return self._rex.match(tag) is not None
+        return self._rex.match(tag + '.') is not None
 
     def emit(self, tag, es):
-        self.output.emit(tag, es)
+        output = self.output
+        t = now()
+        output.emit(tag, es)
+        output.emit_latency.observe(now() - t)
+        output.emit_count += 1
+        output.emit_records += len(es)
 
     def start(self):
         self.output.start()
@@ -51,3 +104,114 @@ class NoMatch(object):
         pass
 
 NoMatch.instance = NoMatch()
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'star', 'globstar', 'wildcards', 'rules', 'is_globstar')
+
+    def __init__(self, is_globstar=False):
+        self.children = {}
+        self.star = None
+        self.globstar = None
+        self.wildcards = []
+        self.rules = []     # このノードで終わるパターンを持つ Match の位置 (昇順)
+        self.is_globstar = is_globstar
+
+    def add(self, seg):
+        if seg == '**':
+            if self.globstar is None:
+                self.globstar = _TrieNode(True)
+            return self.globstar
+        if seg == '*':
+            if self.star is None:
+                self.star = _TrieNode()
+            return self.star
+        if any(c in seg for c in '*?['):
+            src = _translate_segment(seg) + '\\Z'
+            for rex, node in self.wildcards:
+                if rex.pattern == src:
+                    return node
+            node = _TrieNode()
+            self.wildcards.append((re.compile(src), node))
+            return node
+        node = self.children.get(seg)
+        if node is None:
+            node = self.children[seg] = _TrieNode()
+        return node
+
+
+class MatchTrie(object):
+    u"""
+    ``Match`` のリストをセグメント単位のトライにコンパイルする.
+
+    ``match(tag)`` はリストを先頭から ``Match.match`` で走査した場合と
+    同じ結果 (最初にマッチしたもの) を返すが、マッチ数に比例したコストはかからない.
+    """
+
+    def __init__(self, matches):
+        self._matches = list(matches)
+        self._root = _TrieNode()
+        for idx, m in enumerate(self._matches):
+            for pattern in m.patterns:
+                node = self._root
+                for seg in pattern.split('.'):
+                    node = node.add(seg)
+                if idx not in node.rules:
+                    node.rules.append(idx)
+
+    @staticmethod
+    def _closure(nodes):
+        # ``**`` は 0 セグメントにもマッチするので、その先のノードも状態に含める.
+        result = []
+        seen = set()
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            result.append(node)
+            if node.globstar is not None:
+                stack.append(node.globstar)
+        return result
+
+    def _match_states(self, tag):
+        closure = self._closure
+        states = closure([self._root])
+        for seg in tag.split('.'):
+            nexts = []
+            for node in states:
+                if node.is_globstar:
+                    nexts.append(node)
+                child = node.children.get(seg)
+                if child is not None:
+                    nexts.append(child)
+                if node.star is not None:
+                    nexts.append(node.star)
+                for rex, child in node.wildcards:
+                    if rex.match(seg):
+                        nexts.append(child)
+            if not nexts:
+                return []
+            states = closure(nexts)
+        return states
+
+    def match_index(self, tag):
+        u"""最初にマッチした ``Match`` の位置を返す. マッチしなければ None."""
+        rules = [node.rules[0] for node in self._match_states(tag) if node.rules]
+        if not rules:
+            return None
+        return min(rules)
+
+    def match(self, tag):
+        idx = self.match_index(tag)
+        if idx is None:
+            return None
+        return self._matches[idx]
+
+    def match_all(self, tag):
+        u"""マッチしたすべての ``Match`` の位置を昇順で返す."""
+        rules = set()
+        for node in self._match_states(tag):
+            rules.update(node.rules)
+        return sorted(rules)
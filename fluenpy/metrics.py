@@ -0,0 +1,105 @@
+# coding: utf-8
+"""
+    fluenpy.metrics
+    ~~~~~~~~~~~~~~~
+
+    Counters kept by the engine, plugins and buffers, and their rendering
+    to JSON and the Prometheus text format.
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+
+import bisect
+import numbers
+
+#: emit/write の所要時間 (秒) のヒストグラムのバケット.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        u"""``(上限, その値以下の観測数)`` のリストを返す. 最後の上限は inf."""
+        result = []
+        total = 0
+        for le, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            result.append((le, total))
+        return result
+
+    def to_dict(self):
+        return dict(count=self.count, sum=self.sum,
+                    buckets=[[le, n] for le, n in self.cumulative()
+                             if le != float('inf')])
+
+
+def to_json_value(metrics):
+    u"""``metrics()`` が返す dict を JSON にシリアライズできる形にする."""
+    result = {}
+    for key, value in metrics.items():
+        if isinstance(value, Histogram):
+            value = value.to_dict()
+        elif isinstance(value, dict):
+            value = to_json_value(value)
+        result[key] = value
+    return result
+
+
+def _label_str(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v, float):
+        return repr(v)
+    return str(int(v))
+
+
+def to_prometheus(samples):
+    u"""
+    ``(メトリクス名, ラベルの dict, metrics() の dict)`` のリストを
+    Prometheus のテキスト形式にする. 数値とヒストグラム以外の値は出力しない.
+    """
+    families = {}
+    order = []
+    for prefix, labels, metrics in samples:
+        for key, value in sorted(metrics.items()):
+            if not isinstance(value, (numbers.Number, Histogram)):
+                continue
+            name = '%s_%s' % (prefix, key)
+            if name not in families:
+                families[name] = []
+                order.append(name)
+            families[name].append((labels, value))
+
+    lines = []
+    for name in order:
+        entries = families[name]
+        if isinstance(entries[0][1], Histogram):
+            lines.append('# TYPE %s histogram' % (name,))
+            for labels, hist in entries:
+                for le, n in hist.cumulative():
+                    l = dict(labels, le=_format_value(le))
+                    lines.append('%s_bucket{%s} %d' % (name, _label_str(l), n))
+                lines.append('%s_sum{%s} %s' % (name, _label_str(labels), _format_value(hist.sum)))
+                lines.append('%s_count{%s} %d' % (name, _label_str(labels), hist.count))
+        else:
+            lines.append('# TYPE %s gauge' % (name,))
+            for labels, value in entries:
+                lines.append('%s{%s} %s' % (name, _label_str(labels), _format_value(value)))
+    return '\n'.join(lines) + '\n'
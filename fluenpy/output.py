@@ -12,9 +12,15 @@ log = logging.getLogger(__name__)
 
 from fluenpy.plugin import Plugin
 from fluenpy.config import Configurable, config_param
-from time import time as now
+from fluenpy.error import ConfigError
+from fluenpy.event import ArrayEventStream
+from fluenpy.metrics import Histogram
+from calendar import timegm
+from time import time as now, gmtime, localtime, strftime
 import gevent
-import msgpack
+import random
+import gevent.queue
+import gevent.threadpool
 
 try:
     from cStriongIO import StringIO as BytesIO
@@ -28,6 +34,20 @@ except ImportError:
 
 
 class Output(Configurable):
+
+    emit_count = emit_records = 0
+    _emit_latency = None
+
+    @property
+    def emit_latency(self):
+        u"""
+        emit にかかった時間のヒストグラム. ``__init__`` で super を呼ばない
+        サブクラスでも使えるように、初めて使う時に作る.
+        """
+        if self._emit_latency is None:
+            self._emit_latency = Histogram()
+        return self._emit_latency
+
     def start(self):
         pass
 
@@ -37,12 +57,206 @@ class Output(Configurable):
     def emit(self, tag, es):
         pass
 
+    def check_room(self, tag, es):
+        u"""
+        *es* を ``emit`` する空きがあるかを調べる. なければ ``emit`` と同じ
+        ``error.BufferError`` を送出する. バッファを持たない出力はいつでも受け取る.
+        """
+        pass
+
+    def metrics(self):
+        return dict(emit_count=self.emit_count,
+                    emit_records=self.emit_records,
+                    emit_latency=self.emit_latency)
+
     def secondary_init(self, primary):
         if type(self) is not type(primary):
             log.warn("type of secondary output should be same as primary output:"
-                     "primary=%r secondary=%r", type(primary), type(secondary),
+                     "primary=%r secondary=%r", type(primary), type(self),
                      )
 
+
+class RetryState(object):
+    u"""
+    書き出しに失敗した時のリトライの待ち時間を決める.
+    待ち時間は失敗する毎に倍になり、 *max_wait* で頭打ちになる.
+    """
+
+    #: 待ち時間を ±12.5% の範囲でずらして、複数のワーカーや送信元が
+    #: 同時にリトライしないようにする.
+    jitter = 0.125
+
+    def __init__(self, wait, limit, max_wait=None):
+        self.wait = wait
+        self.limit = limit
+        self.max_wait = max_wait
+        self.steps = 0
+        self.next_time = 0
+
+    def reset(self):
+        self.steps = 0
+        self.next_time = 0
+
+    @property
+    def limit_reached(self):
+        return self.steps > self.limit
+
+    def step(self):
+        u"""失敗を1回記録して、次のリトライまでの待ち時間を返す."""
+        wait = self.wait * (2 ** self.steps)
+        if self.max_wait is not None:
+            wait = min(wait, self.max_wait)
+        wait *= 1 + random.uniform(-self.jitter, self.jitter)
+        self.steps += 1
+        self.next_time = now() + wait
+        return wait
+
+
+class _Wakeup(Exception):
+    u"""キューを待っている FlushWorker を終了時に起こす."""
+
+
+class FlushWorker(object):
+    u"""
+    ``BufferedOutput`` のキューからチャンクを取り出して書き出す greenlet.
+    リトライの状態はワーカー毎に持つので、あるチャンクのリトライ中も
+    他のワーカーは書き出しを続ける.
+    """
+
+    def __init__(self, output, id):
+        self.output = output
+        self.id = id
+        self.started_at = now()
+        self.busy_time = 0.0
+        self._busy_since = None
+        self.current = None
+        self.waiting = False
+        self.write_count = self.retry_count = self.num_errors = 0
+        self.retry = RetryState(output.retry_wait, output.retry_limit,
+                                output.max_retry_wait)
+
+    def start(self):
+        self.started_at = now()
+        self._greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        output = self.output
+        buffer = output._buffer
+        while not output._shutdown:
+            self.waiting = True
+            try:
+                chunk = buffer.get(timeout=1.0)
+            except gevent.queue.Empty:
+                continue
+            except _Wakeup:
+                break
+            finally:
+                self.waiting = False
+            # 終了時に kill されたら current のチャンクは書き出されていない.
+            self.current = chunk
+            self._busy_since = now()
+            try:
+                self.write_chunk(chunk)
+            finally:
+                self.busy_time += now() - self._busy_since
+                self._busy_since = None
+            self.current = None
+
+        # 終了時はリトライせずに、期限までキューに残っているチャンクを書き出す.
+        while now() < output._drain_deadline:
+            try:
+                chunk = buffer.get_nowait()
+            except gevent.queue.Empty:
+                break
+            self.current = chunk
+            try:
+                output._write(chunk)
+                buffer.purge(chunk)
+            except Exception as e:
+                log.warn("fail to write at shutdown: %r", e)
+                output._unsent.append(chunk)
+            self.current = None
+
+    def write_chunk(self, chunk):
+        u"""
+        *chunk* を書き出す. 失敗したら待ち時間を増やしながらリトライし、
+        retry_limit を超えたら secondary に書き出す.
+        retry_limit を超えた後のチャンクはリトライせずに1回だけ試し、
+        失敗したらすぐ secondary に回すので、書き出し先が落ちていても
+        キューは流れ続ける. 書き出しに成功したら元に戻る.
+        """
+        output = self.output
+        retry = self.retry
+        while 1:
+            try:
+                t = now()
+                output._write(chunk)
+                output.write_latency.observe(now() - t)
+                self.write_count += 1
+                output.write_count += 1
+                output.bytes_out += len(chunk)
+                output._buffer.purge(chunk)
+                retry.reset()
+                return
+            except Exception as e:
+                log.warn("fail to write: %r", e)
+                self.num_errors += 1
+                output.num_errors += 1
+                output._last_retry_time = now()
+                wait = retry.step()
+                if retry.limit_reached:
+                    break
+                self.retry_count += 1
+                output.retry_count += 1
+                gevent.sleep(wait)
+        self.write_secondary(chunk)
+
+    def write_secondary(self, chunk):
+        output = self.output
+        secondary = output._secondary
+        if secondary is None:
+            log.error("retry_limit is exceeded. throwing away the chunk: "
+                      "key=%r size=%d", chunk.key, len(chunk))
+            output.dropped_chunks += 1
+            output._buffer.purge(chunk)
+            # 次のチャンクは最初からリトライする.
+            self.retry.reset()
+            return
+
+        wait = output.retry_wait
+        for i in range(output._secondary_limit):
+            try:
+                secondary.write(chunk)
+                output.secondary_write_count += 1
+                output._buffer.purge(chunk)
+                return
+            except Exception as e:
+                log.warn("fail to write to secondary: %r", e)
+                gevent.sleep(wait)
+                wait *= 2
+        log.error("failed to write to secondary. throwing away the chunk: "
+                  "key=%r size=%d", chunk.key, len(chunk))
+        output.dropped_chunks += 1
+        output._buffer.purge(chunk)
+
+    def utilization(self):
+        u"""開始してからチャンクを書き出していた時間の割合."""
+        busy = self.busy_time
+        if self._busy_since is not None:
+            busy += now() - self._busy_since
+        elapsed = now() - self.started_at
+        return busy / elapsed if elapsed > 0 else 0.0
+
+    def metrics(self):
+        return dict(busy_time=self.busy_time,
+                    utilization=self.utilization(),
+                    write_count=self.write_count,
+                    retry_count=self.retry_count,
+                    retry_steps=self.retry.steps,
+                    num_errors=self.num_errors,
+                    next_retry_time=self.retry.next_time or None)
+
+
 class BufferedOutput(Output):
 
     _shutdown = False
@@ -50,60 +264,156 @@ class BufferedOutput(Output):
     def __init__(self):
         super(BufferedOutput, self).__init__()
         self._last_retry_time = 0
-        self._next_retry_time = 0
+        self._secondary = None
         self._secondary_limit = 8
-        self._emit_count = 0
+        self._workers = []
+        self._pool = None
+        self._drain_deadline = 0
+        self._unsent = []
+        self.bytes_in = self.bytes_out = 0
+        self.write_count = self.retry_count = self.num_errors = 0
+        self.secondary_write_count = self.dropped_chunks = 0
+        self.write_latency = Histogram()
 
     buffer_type = config_param('string', 'memory')
     retry_limit = config_param('integer', 17)
     retry_wait = config_param('time', 1.0)
+    #: リトライの待ち時間の上限. 指定しなければ上限なし.
+    max_retry_wait = config_param('time', None)
+    #: 終了時に残っているチャンクを書き出す時間の上限.
+    shutdown_timeout = config_param('time', 60)
+
+    #: キューからチャンクを取り出して書き出すワーカーの数.
+    #: flush_thread_count はその別名.
+    num_threads = config_param('integer', 1)
+    flush_thread_count = config_param('integer', None)
+    #: ワーカーの種類. greenlet か thread.
+    #: thread にすると write をスレッドプールで実行する. CPU を使う write 向け.
+    flush_thread_type = config_param('string', 'greenlet')
 
     def configure(self, conf):
         super(BufferedOutput, self).configure(conf)
+        if self.flush_thread_count:
+            self.num_threads = self.flush_thread_count
+        if self.num_threads < 1:
+            raise ConfigError("num_threads should be 1 or more: %r" % (self.num_threads,))
+        if self.flush_thread_type not in ('greenlet', 'thread'):
+            raise ConfigError("flush_thread_type should be greenlet or thread: %r" %
+                              (self.flush_thread_type,))
 
         self._buffer = Plugin.new_buffer(self.buffer_type)
         self._buffer.configure(conf)
-        #todo: secondary
+
+        for e in getattr(conf, 'elements', ()):
+            if e.name != 'secondary':
+                continue
+            type_ = e.get('type') or getattr(self, 'plugin_type', None)
+            if not type_:
+                raise ConfigError("Missing 'type' parameter on <secondary> directive")
+            log.debug("adding secondary output type=%r", type_)
+            secondary = Plugin.new_output(type_)
+            if not hasattr(secondary, 'write'):
+                raise ConfigError("secondary output should be a buffered output: %r" %
+                                  (type_,))
+            secondary.configure(e)
+            secondary.secondary_init(self)
+            self._secondary = secondary
+            break
         #todo: status
 
     def start(self):
         self._buffer.start()
         super(BufferedOutput, self).start()
-        #todo: secondary.start()
-        gevent.spawn(self.run)
+        if self._secondary is not None:
+            self._secondary.start()
+        if self.flush_thread_type == 'thread':
+            self._pool = gevent.threadpool.ThreadPool(self.num_threads)
+        self._workers = [FlushWorker(self, i) for i in range(self.num_threads)]
+        for w in self._workers:
+            w.start()
 
-    def run(self):
-        while not self._shutdown:
-            try:
-                chunk = self._buffer.get(timeout=1.0)
-            except gevent.queue.Empty:
-                continue
-            retry = 0
-            retry_wait = self.retry_wait
-            while retry <= self.retry_limit:
-                try:
-                    self.write(chunk)
-                    break
-                except Exception as e:
-                    log.warn("fail to write: %r", e)
-                    gevent.sleep(retry_wait)
-                    retry_wait *= 2
-        while 1:
-            try:
-                chunk = self._buffer.get_nowait()
-                self.write(chunk.tag, chunk.read())
-            except gevent.queue.Empty:
-                break
+    def _write(self, chunk):
+        if self._pool is not None:
+            return self._pool.apply(self.write, (chunk,))
+        return self.write(chunk)
+
+    def flush_workers(self):
+        return self._workers
 
     def shutdown(self):
-        self._buffer.shutdown()
+        u"""
+        キューに残っているチャンクを shutdown_timeout 秒まで書き出してから
+        終了する. 書き出せなかったチャンクはバッファの ``close`` に渡すので、
+        永続化するバッファやスナップショットを設定したバッファなら次回に書き出す.
+        """
+        self._drain_deadline = deadline = now() + self.shutdown_timeout
+        self._buffer.shutdown(deadline)
         self._shutdown = True
+        for w in self._workers:
+            if w.waiting:
+                w._greenlet.kill(_Wakeup, block=False)
+        greenlets = [w._greenlet for w in self._workers]
+        gevent.joinall(greenlets, timeout=max(0, deadline - now()))
+        unsent = self._unsent
+        for w in self._workers:
+            if not w._greenlet.dead:
+                w._greenlet.kill()
+            if w.current is not None:
+                unsent.append(w.current)
+                w.current = None
+        self._buffer.close(unsent)
+        self._unsent = []
+        if self._secondary is not None:
+            self._secondary.shutdown()
         super(BufferedOutput, self).shutdown()
 
     def emit(self, tag, es, key=''):
-        self._emit_count += 1
+        self.emit_buffer(key, tag, es)
+
+    def emit_buffer(self, key, tag, es, expire=None):
+        u"""
+        *es* を整形して *key* のチャンクに追記する. buffer_chunk_records_limit
+        を超えるストリームは分割する. 分割したうちの一部だけが格納されることはない.
+        """
+        self._emit_items(self.buffer_items(key, tag, es, expire))
+
+    def _emit_items(self, items):
+        self._buffer.emit_all(items)
+        self.bytes_in += sum(len(item[1]) for item in items)
+
+    def stream_items(self, tag, es):
+        u"""``emit(tag, es)`` がバッファに格納するリストを返す."""
+        return self.buffer_items('', tag, es)
+
+    def check_room(self, tag, es):
+        self._buffer.check_room(self.stream_items(tag, es))
+
+    def buffer_items(self, key, tag, es, expire=None):
+        u"""*es* を ``BaseBuffer.emit_all`` に渡すリストにする."""
+        limit = self._buffer.buffer_chunk_records_limit
+        if limit and len(es) > limit:
+            items = []
+            for i in range(0, len(es), limit):
+                items += self.buffer_items(key, tag, es[i:i+limit], expire)
+            return items
         data = self.format_stream(tag, es)
-        self._buffer.emit(key, data)
+        return [(key, data, expire, len(es), es.time_range(), False)]
+
+    def metrics(self):
+        m = super(BufferedOutput, self).metrics()
+        m.update(bytes_in=self.bytes_in,
+                 bytes_out=self.bytes_out,
+                 write_count=self.write_count,
+                 write_latency=self.write_latency,
+                 retry_count=self.retry_count,
+                 num_errors=self.num_errors,
+                 secondary_write_count=self.secondary_write_count,
+                 dropped_chunks=self.dropped_chunks,
+                 next_retry_time=min([w.retry.next_time for w in self._workers
+                                      if w.retry.next_time] or [None]),
+                 flush_workers=dict((str(w.id), w.metrics()) for w in self._workers))
+        m.update(self._buffer.metrics())
+        return m
 
     def write(self, chunk):
         raise NotImplemented
@@ -119,18 +429,89 @@ class BufferedOutput(Output):
         return buf.getvalue()
 
 
+class TimeSlicedOutput(BufferedOutput):
+    u"""
+    イベントの時刻を ``time_slice_format`` で整形した文字列をキーにして
+    バッファリングする. チャンクは時間帯が終わってから time_slice_wait 秒後に
+    フラッシュされるので、 ``write`` は ``chunk.key`` の時間帯のイベントを
+    まとめて受け取る.
+    """
+
+    time_slice_format = config_param('string', '%Y%m%d')
+    time_slice_wait = config_param('time', 10 * 60)
+    utc = config_param('bool', False)
+
+    def configure(self, conf):
+        super(TimeSlicedOutput, self).configure(conf)
+        fmt = self.time_slice_format
+        # 時間帯の長さ. 月や年で区切る書式は1日毎に区切る.
+        if '%S' in fmt or '%s' in fmt:
+            self._slice_interval = 1
+        elif '%M' in fmt:
+            self._slice_interval = 60
+        elif '%H' in fmt:
+            self._slice_interval = 60 * 60
+        else:
+            self._slice_interval = 24 * 60 * 60
+        self._slice_cache = (0, 0, None)
+
+    def time_slice(self, time):
+        u"""*time* の時間帯の ``(キー, 時間帯の終わりの時刻)`` を返す."""
+        start, end, key = self._slice_cache
+        if not start <= time < end:
+            t = int(time)
+            tm = gmtime(t) if self.utc else localtime(t)
+            offset = timegm(tm) - t
+            start = t - (t + offset) % self._slice_interval
+            end = start + self._slice_interval
+            key = strftime(self.time_slice_format, tm)
+            self._slice_cache = (start, end, key)
+        return key, end
+
+    def emit(self, tag, es):
+        self._emit_items(self.stream_items(tag, es))
+
+    def stream_items(self, tag, es):
+        time_slice = self.time_slice
+        groups = {}
+        for time, record in es:
+            slice_ = time_slice(time)
+            entries = groups.get(slice_)
+            if entries is None:
+                entries = groups[slice_] = []
+            entries.append((time, record))
+
+        items = []
+        for (key, end), entries in groups.items():
+            if len(groups) > 1:
+                es = ArrayEventStream(entries)
+            items += self.buffer_items(key, tag, es, expire=end + self.time_slice_wait)
+        return items
+
+
 class ObjectBufferedOutput(BufferedOutput):
     u"""
     ``chunk`` に msgpack 形式でデータを格納する.
     継承したクラスは ``format`` メソッドを実装する必要がない.
+    イベントは ``es.to_mpac()`` でシリアライズするので、同じストリームを
+    複数の出力に渡しても pack は一度しか行われない.
     """
 
     def emit(self, tag, es):
-        self._emit_count += 1
-        if callable(getattr(es, 'to_mpac', None)):
-            data = es.to_mpac()
-        else:
-            data = b''.join(map(msgpack.packb, es))
-        key = tag
-        self._buffer.emit(key, data)
+        self.emit_buffer(tag, tag, es)
+
+    def stream_items(self, tag, es):
+        return self.buffer_items(tag, tag, es)
+
+    def buffer_items(self, key, tag, es, expire=None):
+        # 圧縮されたまま受け取ったイベント列は、圧縮しなおさずに格納する.
+        compressed_mpac = getattr(es, 'compressed_mpac', None)
+        limit = self._buffer.buffer_chunk_records_limit
+        if (compressed_mpac is None or self._buffer.compress != 'gzip' or
+                (limit and len(es) > limit)):
+            return super(ObjectBufferedOutput, self).buffer_items(key, tag, es, expire)
+        return [(key, compressed_mpac(), expire, len(es), es.time_range(), True)]
+
+    def format_stream(self, tag, es):
+        return es.to_mpac()
 
@@ -22,6 +22,7 @@ class PluginClass(object):
     def __init__(self):
         self._input = {}
         self._output = {}
+        self._filter = {}
         self._buffer = {}
 
     def register_input(self, type, klass):
@@ -32,15 +33,27 @@ class PluginClass(object):
         self._output[type] = klass
         log.debug("registered output plugin %r", type)
 
+    def register_filter(self, type, klass):
+        self._filter[type] = klass
+        log.debug("registered filter plugin %r", type)
+
     def register_buffer(self, type, klass):
         self._buffer[type] = klass
         log.debug("registered buffer plugin %r", type)
 
     def new_input(self, type):
-        return self._input[type]()
+        return self._new(self._input, type)
 
     def new_output(self, type):
-        return self._output[type]()
+        return self._new(self._output, type)
+
+    def new_filter(self, type):
+        return self._new(self._filter, type)
+
+    def _new(self, registry, type):
+        plugin = registry[type]()
+        plugin.plugin_type = type
+        return plugin
 
     def new_buffer(self, type):
         return self._buffer[type]()
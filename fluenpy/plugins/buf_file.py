@@ -0,0 +1,215 @@
+# coding: utf-8
+"""
+    fluenpy.plugins.buf_file
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Buffer chunks in files::
+
+        <match app.**>
+          type forward
+          buffer_type file
+          buffer_path /var/log/fluenpy/buffer/forward
+          ...
+        </match>
+
+    Each chunk is a file named ``<buffer_path>.<key>.<state><id>.log``
+    (``.log.gz`` with ``compress gzip``).
+    ``state`` is ``b`` while the chunk is staged and ``q`` once it is queued,
+    so both can be restored from the file names after a restart or crash.
+    Queued chunks also have a ``.log.meta`` JSON file holding their metadata.
+    With ``--workers N``, each worker uses ``worker<id>/`` in the directory of
+    ``buffer_path``.
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+import logging
+log = logging.getLogger(__name__)
+
+import json
+import os
+import random
+import re
+from time import time as now
+
+from fluenpy.plugin import Plugin
+from fluenpy.buffer import BaseBufferChunk, BaseBuffer, worker_path
+from fluenpy.config import config_param
+
+try:
+    from urllib import quote, unquote
+except ImportError:
+    from urllib.parse import quote, unquote
+
+
+def unique_id():
+    u"""時刻順に並ぶ一意な16進文字列を返す."""
+    return '%014x%08x' % (int(now() * 1000000), random.getrandbits(32))
+
+
+class FileBufferChunk(BaseBufferChunk):
+    def __init__(self, key, expire, path, unique_id, size=None):
+        super(FileBufferChunk, self).__init__(key, expire)
+        self.path = path
+        self.unique_id = unique_id
+        if size is None:
+            self._file = open(path, 'ab')
+            self._size = 0
+        else:
+            # 復元したチャンク
+            self._file = None
+            self._size = size
+
+    def __iadd__(self, data):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        return self
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def raw_read(self):
+        with self.raw_open() as f:
+            return f.read()
+
+    def raw_open(self):
+        if self._file is not None:
+            self._file.flush()
+        return open(self.path, 'rb')
+
+    def mv(self, path):
+        os.rename(self.path, path)
+        self.path = path
+
+    def write_metadata(self):
+        meta = self.metadata()
+        del meta['key'], meta['size']
+        with open(self.path + '.meta', 'w') as f:
+            json.dump(meta, f)
+
+    def read_metadata(self):
+        try:
+            with open(self.path + '.meta') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return
+        self.records = meta.get('records', 0)
+        self.first_time = meta.get('first_time')
+        self.last_time = meta.get('last_time')
+        self.created_at = meta.get('created_at', self.created_at)
+
+    def purge(self):
+        self.close()
+        for path in (self.path, self.path + '.meta'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._size = 0
+
+
+class FileBuffer(BaseBuffer):
+
+    buffer_path = config_param('string')
+    buffer_chunk_limit = config_param('size', 8 * 1024**2)
+    buffer_queue_limit = config_param('integer', 256)
+
+    in_memory = False
+
+    _suffix_re = re.compile(r'^\.(?P<key>[^/]*)\.(?P<state>[bq])(?P<id>[0-9a-f]+)\.log(?P<gz>\.gz)?$')
+
+    def configure(self, conf):
+        super(FileBuffer, self).configure(conf)
+        # spill_to_disk のバッファもこれを使うので、spill_path も同じになる.
+        self.buffer_path = worker_path(self.buffer_path)
+
+    def _chunk_path(self, key, state, id, compressed):
+        return '%s.%s.%s%s.log%s' % (self.buffer_path, quote(key, safe=''), state, id,
+                                     '.gz' if compressed else '')
+
+    def new_chunk(self, key, expire):
+        id = unique_id()
+        path = self._chunk_path(key, 'b', id, self.compress == 'gzip')
+        return FileBufferChunk(key, expire, path, id)
+
+    def enqueue(self, chunk):
+        chunk.close()
+        chunk.mv(self._chunk_path(chunk.key, 'q', chunk.unique_id, chunk.compressed))
+        chunk.write_metadata()
+
+    def close(self, unsent=()):
+        u"""
+        ファイルを閉じるだけでチャンクは消さない. 書き出せなかったチャンクは
+        キューに入った状態にして、ステージ中のチャンクと一緒に次回の ``resume``
+        で復元する.
+        """
+        unsent = list(unsent)
+        remaining = self.remaining_chunks()
+        for chunk in unsent:
+            if chunk.path != self._chunk_path(chunk.key, 'q', chunk.unique_id,
+                                              chunk.compressed):
+                self.enqueue(chunk)
+            chunk.close()
+        for chunk in remaining:
+            chunk.finish()
+            chunk.close()
+        if unsent or remaining:
+            log.info("left %d chunks in %s", len(unsent) + len(remaining),
+                     self.buffer_path)
+
+    def resume(self):
+        dirname, basename = os.path.split(self.buffer_path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        queued = []
+        staged = []
+        for name in os.listdir(dirname or '.'):
+            if not name.startswith(basename + '.'):
+                continue
+            m = self._suffix_re.match(name[len(basename):])
+            if not m:
+                continue
+            path = os.path.join(dirname, name)
+            st = os.stat(path)
+            key = unquote(m.group('key'))
+            chunk = FileBufferChunk(key, st.st_mtime + self.flush_interval,
+                                    path, m.group('id'), st.st_size)
+            chunk.compressed = bool(m.group('gz'))
+            if m.group('state') == 'q':
+                chunk.read_metadata()
+                queued.append(chunk)
+            elif chunk.compressed:
+                # 圧縮の状態は復元できないので追記せずにキューに入れる.
+                self.enqueue(chunk)
+                queued.append(chunk)
+            else:
+                staged.append(chunk)
+
+        by_id = lambda c: c.unique_id
+        # 同じ key のステージ済みチャンクが複数あれば、最新のもの以外はキューに入れる.
+        map_ = {}
+        for chunk in sorted(staged, key=by_id):
+            old = map_.get(chunk.key)
+            if old is not None:
+                self.enqueue(old)
+                queued.append(old)
+            map_[chunk.key] = chunk
+        queued.sort(key=by_id)
+
+        if queued or map_:
+            log.info("resumed %d queued and %d staged chunks from %s",
+                     len(queued), len(map_), self.buffer_path)
+        return queued, map_
+
+
+Plugin.register_buffer('file', FileBuffer)
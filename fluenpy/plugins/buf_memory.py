@@ -3,6 +3,18 @@
     fluenpy.plugins.buf_memory
     ~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    Buffer chunks in memory.  With ``snapshot_path``, chunks which are not
+    written at shutdown are saved to the file and queued again at startup.
+    With ``--workers N``, each worker uses ``worker<id>/`` in the directory of
+    ``snapshot_path``::
+
+        <match app.**>
+          type forward
+          buffer_type memory
+          snapshot_path /var/log/fluenpy/buffer/forward.snapshot
+          ...
+        </match>
+
     :copyright: (c) 2012 by INADA Naoki
     :license: Apache v2
 """
@@ -10,33 +22,62 @@ from __future__ import print_function, division, absolute_import, with_statement
 import logging
 Log = logging.getLogger(__name__)
 
+import os
+from time import time as now
+
+import msgpack
+
 from fluenpy.plugin import Plugin
-from fluenpy.buffer import BaseBufferChunk, BaseBuffer
+from fluenpy.buffer import BaseBufferChunk, BaseBuffer, worker_path
 from fluenpy.config import config_param
 
-try:
-    from cStringIO import StringIO as BytesIO
-except ImportError:
-    from io import BytesIO
+#: これより小さいデータはまとめてから1つのセグメントにする.
+SEGMENT_SIZE = 64 * 1024
 
 
 class MemoryBufferChunk(BaseBufferChunk):
+    u"""
+    データを bytes のセグメントのリストで保持するチャンク.
+    大きなデータはコピーせずにそのままセグメントにする. 小さなデータは
+    セグメント数が増えすぎないように SEGMENT_SIZE までまとめる.
+    """
+
     def __init__(self, key, expire):
         super(MemoryBufferChunk, self).__init__(key, expire)
-        self._buf = BytesIO()
+        self._segments = []
+        self._tail = bytearray()
+        self._size = 0
 
     def __iadd__(self, data):
-        self._buf.write(data)
+        if len(data) >= SEGMENT_SIZE:
+            self._flush_tail()
+            self._segments.append(bytes(data))
+        else:
+            self._tail += data
+            if len(self._tail) >= SEGMENT_SIZE:
+                self._flush_tail()
+        self._size += len(data)
         return self
 
+    def _flush_tail(self):
+        if self._tail:
+            self._segments.append(bytes(self._tail))
+            self._tail = bytearray()
+
     def __len__(self):
-        return self._buf.tell()
+        return self._size
+
+    def raw_segments(self):
+        self._flush_tail()
+        return list(self._segments)
 
-    def read(self):
-        return self._buf.getvalue()
+    def raw_read(self):
+        return b''.join(self.raw_segments())
 
     def purge(self):
-        self._buf = BytesIO()
+        self._segments = []
+        self._tail = bytearray()
+        self._size = 0
 
 
 class MemoryBuffer(BaseBuffer):
@@ -44,9 +85,52 @@ class MemoryBuffer(BaseBuffer):
     buffer_chunk_limit = config_param("size", 32 * 1024**2)
     buffer_queue_limit = config_param("integer", 32)
     flush_interval = config_param('time', 5)
+    snapshot_path = config_param('string', None)
+
+    def configure(self, conf):
+        super(MemoryBuffer, self).configure(conf)
+        self.snapshot_path = worker_path(self.snapshot_path)
 
     def new_chunk(self, key, expire):
         return MemoryBufferChunk(key, expire)
 
+    def resume(self):
+        path = self.snapshot_path
+        if not path or not os.path.exists(path):
+            return [], {}
+        queued = []
+        with open(path, 'rb') as f:
+            for key, compressed, meta, data in msgpack.Unpacker(f, raw=False):
+                chunk = self.new_chunk(key, now())
+                chunk += data
+                chunk.compressed = compressed
+                chunk.add_metadata(meta['records'], meta['first_time'], meta['last_time'])
+                chunk.created_at = meta['created_at']
+                queued.append(chunk)
+        # 二重に書き出さないように、読み込んだら消す.
+        os.unlink(path)
+        Log.info("resumed %d chunks from snapshot %s", len(queued), path)
+        return queued, {}
+
+    def close(self, unsent=()):
+        path = self.snapshot_path
+        chunks = list(unsent) + self.remaining_chunks()
+        if not path or not chunks:
+            return super(MemoryBuffer, self).close(unsent)
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        packer = msgpack.Packer(use_bin_type=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                chunk.finish()
+                f.write(packer.pack([chunk.key, chunk.compressed,
+                                     chunk.metadata(), chunk.raw_read()]))
+        os.rename(tmp, path)
+        Log.info("saved %d chunks to snapshot %s", len(chunks), path)
+        for chunk in chunks:
+            self.purge(chunk)
+
 
 Plugin.register_buffer('memory', MemoryBuffer)
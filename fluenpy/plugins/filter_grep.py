@@ -0,0 +1,84 @@
+# coding: utf-8
+"""
+    fluenpy.plugins.filter_grep
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Filter records by regular expressions::
+
+        <filter app.**>
+          type grep
+          regexp1 level ^(warn|error)$
+          exclude1 path ^/healthcheck
+        </filter>
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+import logging
+log = logging.getLogger(__name__)
+
+import re
+from fluenpy import error
+from fluenpy.event import ArrayEventStream
+from fluenpy.filter import Filter
+from fluenpy.plugin import Plugin
+
+MAX_PATTERNS = 20
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def _to_text(value):
+    u"""文字列はそのまま返し、それ以外の値は unicode にする."""
+    if isinstance(value, (bytes, text_type)):
+        return value
+    return text_type(value)
+
+
+class GrepFilter(Filter):
+
+    def __init__(self):
+        super(GrepFilter, self).__init__()
+        self._regexps = []
+        self._excludes = []
+
+    def _parse_patterns(self, conf, prefix):
+        patterns = []
+        for i in range(1, MAX_PATTERNS + 1):
+            value = conf.get('%s%d' % (prefix, i))
+            if value is None:
+                continue
+            try:
+                key, rex = value.split(None, 1)
+            except ValueError:
+                raise error.ConfigError("%s%d requires 'key pattern'" % (prefix, i))
+            patterns.append((key, re.compile(rex)))
+        return patterns
+
+    def configure(self, conf):
+        super(GrepFilter, self).configure(conf)
+        self._regexps = self._parse_patterns(conf, 'regexp')
+        self._excludes = self._parse_patterns(conf, 'exclude')
+
+    def filter_stream(self, tag, es):
+        regexps = self._regexps
+        excludes = self._excludes
+        entries = []
+        for time, record in es:
+            for key, rex in regexps:
+                if not rex.search(_to_text(record.get(key, ''))):
+                    break
+            else:
+                for key, rex in excludes:
+                    if rex.search(_to_text(record.get(key, ''))):
+                        break
+                else:
+                    entries.append((time, record))
+        return ArrayEventStream(entries)
+
+
+Plugin.register_filter('grep', GrepFilter)
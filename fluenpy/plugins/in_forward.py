@@ -13,106 +13,189 @@ log = logging.getLogger(__name__)
 from time import time as now
 
 from fluenpy.engine import Engine
+from fluenpy.event import (ArrayEventStream, CompressedMessagePackEventStream,
+                           MessagePackEventStream, OneEventStream, ext_hook)
 from fluenpy.plugin import Plugin
-from fluenpy.input import Input
+from fluenpy.input import Input, bind_socket
 from fluenpy.config import config_param
+from gevent.pool import Pool
 from gevent.server import DatagramServer, StreamServer
+import gevent.socket as socket
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
-from msgpack import Unpacker
+from msgpack import BufferFull, Unpacker, packb
 
 
-class UnpackStream(object):
-    def __init__(self, bytes):
-        self._bytes = bytes
+def _option(msg, index):
+    u"""*msg* の *index* 番目にある option を、キーを文字列にした dict で返す."""
+    if len(msg) <= index or not isinstance(msg[index], dict):
+        return {}
+    return dict((k.decode('utf-8') if isinstance(k, bytes) else k, v)
+                for k, v in msg[index].items())
 
-    def __iter__(self):
-        unp = Unpacker()
-        unp.feed(self._bytes)
-        return unp
-
-    def to_mpac(self):
-        return self._bytes
 
 class HeartbeatServer(DatagramServer):
     def handle(self, data, address):
         self.socket.sendto('', address)
 
+class _Connection(object):
+    u"""1つの接続で使い回す受信バッファ."""
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.unpacker = None
+        self.fed = 0
+
+    def buffered_bytes(self):
+        u"""受信バッファと、まだメッセージになっていないデータのバイト数."""
+        n = len(self.buf)
+        if self.unpacker is not None:
+            n += self.fed - self.unpacker.tell()
+        return n
+
+
 class ForwardInput(Input):
 
     port = config_param('integer', 9880)
     bind = config_param('string', '0.0.0.0')
+    #: 接続毎に確保する受信バッファのサイズ.
+    recv_buffer_size = config_param('size', 256 * 1024)
+    #: 1つのメッセージの最大サイズ. 超えたら接続を切る. 指定しなければ上限なし.
+    chunk_size_limit = config_param('size', None)
+
+    multi_workers = True
+
+    def __init__(self):
+        super(ForwardInput, self).__init__()
+        self._connections = set()
 
     def start(self):
         log.info("start forward server on %s:%s", self.bind, self.port)
-        self._server = StreamServer((self.bind, self.port), self.on_connect)
+        address = (self.bind, self.port)
+        reuse_port = Engine.workers > 1
+        # 送信側は接続を使い回すので、終了時に閉じられるように Pool で管理する.
+        self._server = StreamServer(
+                bind_socket(address, reuse_port=reuse_port), self.on_connect,
+                spawn=Pool())
         self._server.start()
-        self._hbserver = HeartbeatServer((self.bind, self.port))
+        self._hbserver = HeartbeatServer(
+                bind_socket(address, socket.SOCK_DGRAM, reuse_port=reuse_port))
         self._hbserver.start()
 
     def shutdown(self):
         self._hbserver.stop()
-        self._server.stop()
+        self._server.stop(timeout=0)
+
+    def metrics(self):
+        m = super(ForwardInput, self).metrics()
+        m.update(connections=len(self._connections),
+                 buffered_bytes=sum(c.buffered_bytes() for c in self._connections))
+        return m
 
     def on_message(self, msg):
+        u"""
+        forward プロトコルのメッセージを emit する. 送信側が ack を求めていれば、
+        emit に成功した後で返すべきチャンク ID を返す.
+
+        Message
+            ``[tag, time, record, option?]``
+        Forward
+            ``[tag, [[time, record], ...], option?]``
+        PackedForward
+            ``[tag, msgpack でシリアライズしたイベント列, option?]``
+        CompressedPackedForward
+            PackedForward のイベント列を gzip で圧縮したもの.
+            option に ``compressed: gzip`` を持つ.
+        """
         tag = msg[0]
         log.debug("on_message: recieved message %s", tag)
         entries = msg[1]
         ent_type = type(entries)
 
         if ent_type is bytes:
-            Engine.emit_stream(tag, UnpackStream(entries))
+            option = _option(msg, 2)
+            compressed = option.get('compressed')
+            if compressed in (b'gzip', u'gzip'):
+                es = CompressedMessagePackEventStream(entries, option.get('size'))
+            elif compressed in (None, b'text', u'text'):
+                es = MessagePackEventStream(entries, option.get('size'))
+            else:
+                log.warn("unsupported compression %r from tag=%s. ignored.",
+                         compressed, tag)
+                return None
         elif ent_type in (list, tuple):
-            Engine.emit_stream(
-                    tag,
-                    [(e[0] or now(), e[1]) for e in entries],
-                    )
+            option = _option(msg, 2)
+            es = ArrayEventStream([(e[0] or now(), e[1]) for e in entries])
         else:
-            Engine.emit(tag, msg[1] or now(), msg[2])
+            option = _option(msg, 3)
+            es = OneEventStream(msg[1] or now(), msg[2])
+        self.emit_stream(tag, es)
+        return option.get('chunk')
 
-
-    def json_handler(self, data, sock):
+    def json_handler(self, data, sock, conn):
         decode = json.JSONDecoder().raw_decode
         pos = 0
         while 1:
             try:
                 obj, pos = decode(data, pos)
-                self.on_message(obj)
+                chunk = self.on_message(obj)
+                if chunk:
+                    sock.sendall(json.dumps({'ack': chunk}).encode('utf-8'))
             except (ValueError, StopIteration):
                 data = data[pos:]
-                next_data = sock.recv(128*1024)
-                if not next_data:
+                n = sock.recv_into(conn.buf)
+                if not n:
                     break
-                data += next_data
+                self.bytes_in += n
+                data += bytes(conn.buf[:n])
                 pos = 0
 
-    def mpack_handler(self, data, sock):
-        unpacker = Unpacker()
-        unpacker.feed(data)
-        # default chunk size of memory buffer is 32MB
-        RECV_SIZE = 32*1024*1024
-        while 1:
-            for msg in unpacker:
-                self.on_message(msg)
-            next_data = sock.recv(RECV_SIZE)
-            if not next_data:
-                break
-            unpacker.feed(next_data)
+    def mpack_handler(self, n, sock, conn):
+        unpacker = conn.unpacker = Unpacker(ext_hook=ext_hook,
+                                            max_buffer_size=self.chunk_size_limit or 0)
+        limit = self.chunk_size_limit
+        view = memoryview(conn.buf)
+        while n:
+            pos = 0
+            while pos < n:
+                size = n - pos
+                if limit:
+                    # recv_buffer_size が chunk_size_limit より大きくても小さな
+                    # メッセージは受け付けるように、Unpacker の空き容量ずつ渡す.
+                    size = min(size, limit - (conn.fed - unpacker.tell()))
+                    if size <= 0:
+                        raise BufferFull
+                unpacker.feed(view[pos:pos+size])
+                conn.fed += size
+                pos += size
+                for msg in unpacker:
+                    chunk = self.on_message(msg)
+                    if chunk:
+                        sock.sendall(packb({'ack': chunk}))
+            n = sock.recv_into(conn.buf)
+            self.bytes_in += n
 
     def on_connect(self, sock, addr):
+        conn = _Connection(self.recv_buffer_size)
+        self._connections.add(conn)
         try:
-            data = sock.recv(128*1024)
-            if not data:
+            n = sock.recv_into(conn.buf)
+            if not n:
                 return
-            if data[0] in b'{[':
-                self.json_handler(data, sock)
+            self.bytes_in += n
+            if conn.buf[:1] in (b'{', b'['):
+                self.json_handler(bytes(conn.buf[:n]), sock, conn)
             else:
-                self.mpack_handler(data, sock)
+                self.mpack_handler(n, sock, conn)
+        except BufferFull:
+            log.warn("message from %s exceeds chunk_size_limit (%d bytes). "
+                     "closing the connection.", addr, self.chunk_size_limit)
         finally:
+            self._connections.discard(conn)
             sock.close()
 
 Plugin.register_input('forward', ForwardInput)
@@ -15,11 +15,19 @@ import os
 import cgi
 import time
 
+from fluenpy import error
 from fluenpy.engine import Engine
+from fluenpy.event import OneEventStream
 from fluenpy.plugin import Plugin
-from fluenpy.input import Input
+from fluenpy.input import Input, bind_socket
 from fluenpy.config import config_param
 from gevent.pywsgi import WSGIServer
+import msgpack
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 
 class Httpinput(Input):
@@ -28,6 +36,8 @@ class Httpinput(Input):
     bind = config_param('string', '0.0.0.0')
     # TODO: body_size_limit, keepalive_timeout
 
+    multi_workers = True
+
     def wsgi_app(self, env, start):
         path = env['PATH_INFO'].strip('/')
         tag = path.replace('/', '.')
@@ -57,14 +67,22 @@ class Httpinput(Input):
             time_ = int(time.time())
 
         log.debug("Recieve message: tag=%r, record=%r", tag, record)
-        Engine.emit(tag, time_, record)
+        try:
+            self.emit_stream(tag, OneEventStream(time_, record), block=False)
+        except error.BufferError as e:
+            # クライアントにリトライしてもらう.
+            log.warn("buffer is full. rejecting: tag=%s error=%s", tag, e)
+            start("503 Service Unavailable", [('Content-Type', 'text/plain'),
+                                              ('Retry-After', '1')])
+            return [""]
 
         start("200 OK", [('Content-Type', 'text/plain')])
         return [""]
 
     def start(self):
         log.info("start http server on %s:%s", self.bind, self.port)
-        self._server = server = WSGIServer((self.bind, self.port), self.wsgi_app, log=None)
+        listener = bind_socket((self.bind, self.port), reuse_port=Engine.workers > 1)
+        self._server = server = WSGIServer(listener, self.wsgi_app, log=None)
         server.start()
 
     def shutdown(self):
@@ -0,0 +1,109 @@
+# coding: utf-8
+"""
+    fluenpy.plugins.in_monitor_agent
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Export internal metrics over HTTP::
+
+        <source>
+          type monitor_agent
+          port 24220
+        </source>
+
+    ``GET /api/plugins.json`` returns metrics for each plugin as JSON and
+    ``GET /metrics`` returns them in the Prometheus text format.
+    The servers of a forward output are exported as ``fluenpy_forward_node_*``
+    gauges labelled with ``node="host:port"``.
+
+    With ``--workers N`` this source runs only on worker 0, so the metrics
+    are those of worker 0 alone; the other workers are not included.
+
+    :copyright: (c) 2012 by INADA Naoki
+    :license: Apache v2
+"""
+from __future__ import print_function, division, absolute_import, with_statement
+import logging
+log = logging.getLogger(__name__)
+
+from fluenpy import metrics
+from fluenpy.buffer import FlushScheduler, MemoryBudget
+from fluenpy.engine import Engine
+from fluenpy.plugin import Plugin
+from fluenpy.input import Input, bind_socket
+from fluenpy.config import config_param
+from gevent.pywsgi import WSGIServer
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+def plugin_id(plugin):
+    return 'object:%x' % (id(plugin),)
+
+
+class MonitorAgentInput(Input):
+
+    port = config_param('integer', 24220)
+    bind = config_param('string', '0.0.0.0')
+
+    def plugins_json(self):
+        plugins = []
+        for category, plugin in Engine.plugins():
+            plugins.append(dict(
+                plugin_id=plugin_id(plugin),
+                plugin_category=category,
+                type=getattr(plugin, 'plugin_type', None),
+                metrics=metrics.to_json_value(plugin.metrics()),
+                ))
+        return json.dumps(dict(
+            worker_id=Engine.worker_id,
+            engine=metrics.to_json_value(Engine.metrics()),
+            plugins=plugins,
+            ))
+
+    def prometheus(self):
+        worker = dict(worker_id=Engine.worker_id)
+        samples = [
+            ('fluenpy_engine', worker, Engine.metrics()),
+            ('fluenpy_engine_match_cache', worker, Engine.match_cache_stats()),
+            ('fluenpy_buffer_total', worker, MemoryBudget.stats()),
+            ('fluenpy_flush_scheduler', worker, FlushScheduler.stats()),
+            ]
+        for category, plugin in Engine.plugins():
+            labels = dict(worker, plugin_id=plugin_id(plugin),
+                          type=getattr(plugin, 'plugin_type', ''))
+            samples.append(('fluenpy_' + category, labels, plugin.metrics()))
+            for w in getattr(plugin, 'flush_workers', list)():
+                samples.append(('fluenpy_flush_worker',
+                                dict(labels, flush_worker_id=w.id), w.metrics()))
+            for node in getattr(plugin, 'forward_nodes', list)():
+                samples.append(('fluenpy_forward_node',
+                                dict(labels, node=repr(node)), node.metrics()))
+        return metrics.to_prometheus(samples)
+
+    def wsgi_app(self, env, start):
+        path = env['PATH_INFO'].rstrip('/')
+        if path == '/api/plugins.json':
+            body = self.plugins_json()
+            content_type = 'application/json'
+        elif path == '/metrics':
+            body = self.prometheus()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            start("404 Not Found", [('Content-Type', 'text/plain')])
+            return [b"Not Found\n"]
+        start("200 OK", [('Content-Type', content_type)])
+        return [body]
+
+    def start(self):
+        log.info("start monitor agent on %s:%s", self.bind, self.port)
+        self._server = WSGIServer(bind_socket((self.bind, self.port)),
+                                  self.wsgi_app, log=None)
+        self._server.start()
+
+    def shutdown(self):
+        self._server.stop()
+
+Plugin.register_input('monitor_agent', MonitorAgentInput)
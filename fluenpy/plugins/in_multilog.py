@@ -17,7 +17,7 @@ import glob
 
 from fluenpy.plugin import Plugin
 from fluenpy.input import Input
-from fluenpy.engine import Engine
+from fluenpy.event import OneEventStream
 from fluenpy.config import config_param
 import gevent
 import gdbm
@@ -113,7 +113,7 @@ class MultilogInput(Input):
             tai -= 2**62
         else:
             tai = 0
-        Engine.emit(self.tag, tai, {self.key: line})
+        self.emit_stream(self.tag, OneEventStream(tai, {self.key: line}))
 
     def run(self):
         db = gdbm.open(self.pos_file, 'cs')
@@ -19,7 +19,7 @@ import re
 import gevent
 from fluenpy.plugin import Plugin
 from fluenpy.input import Input
-from fluenpy.engine import Engine
+from fluenpy.event import ArrayEventStream
 from fluenpy.config import config_param
 from fluenpy.parser import TextParser
 
@@ -60,8 +60,8 @@ class TailInput(Input):
         self.parser.configure(conf)
 
     def receive_lines(self, lines):
-        lines = map(self.parser.parse, lines)
-        Engine.emit_stream(self.tag, lines)
+        es = ArrayEventStream(list(map(self.parser.parse, lines)))
+        self.emit_stream(self.tag, es)
 
     def run(self):
         watchers = []
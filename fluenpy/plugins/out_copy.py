@@ -18,6 +18,14 @@ from fluenpy.plugin import Plugin
 
 
 class CopyOutput(Output):
+    u"""
+    同じイベントを全ての ``<store>`` に emit する.
+
+    先に全ての store に空きがあるかを調べて、どれかが一杯なら
+    どの store にも emit せずに ``error.BufferError`` を送出して入力側に伝える.
+    入力はストリーム全体を emit しなおす. 調べた後に一杯になった store があった
+    時だけは、既に受け取った store に同じイベントが重複して入る.
+    """
 
     def __init__(self):
         super(CopyOutput, self).__init__()
@@ -48,13 +56,25 @@ class CopyOutput(Output):
                 log.error("Error occured while shutdown:")
                 log.error(traceback.format_exc())
 
+    def check_room(self, tag, es):
+        for o in self._outputs:
+            o.check_room(tag, es)
+
     def emit(self, tag, es):
+        # 一杯の store があれば、どの store にも emit しない.
+        self.check_room(tag, es)
+        full = None
         for o in self._outputs:
             try:
                 o.emit(tag, es)
+            except error.BufferError as e:
+                if full is None:
+                    full = e
             except Exception:
                 log.error("Error occured while emit:")
                 log.error(traceback.format_exc())
+        if full is not None:
+            raise full
 
 
 Plugin.register_output('copy', CopyOutput)
@@ -3,6 +3,40 @@
     fluenpy.plugins.out_forward
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    Forward chunks to other fluentd/fluenpy servers::
+
+        <match app.**>
+          type forward
+          heartbeat_type udp
+          phi_threshold 16
+          heartbeat_interval 1
+          <server>
+            host 192.168.0.1
+            weight 60
+          </server>
+          <server>
+            host 192.168.0.2
+            weight 30
+          </server>
+          <server>
+            host 192.168.0.3
+            standby true
+          </server>
+        </match>
+
+    Chunks are distributed to the available servers by ``weight``.
+    ``standby`` servers are used only when no other server is available.
+    With ``heartbeat_type udp``, a server is detached when the phi accrual
+    failure detector on its UDP heartbeats exceeds ``phi_threshold``, or when
+    sending to it fails, and attached again when heartbeats arrive.
+    The default ``heartbeat_type none`` never detaches servers, so the
+    servers need not answer UDP heartbeats.
+
+    With ``require_ack_response true`` each flush worker waits for the ack of
+    the chunk it sent before it sends the next one, so at most ``num_threads``
+    chunks are in flight.  ``num_threads`` defaults to 8 in this case.
+    A chunk is sent with the same ``chunk`` id on every retry.
+
     :copyright: (c) 2012 by INADA Naoki
     :license: Apache v2
 """
@@ -14,54 +48,483 @@ log = logging.getLogger(__name__)
 from fluenpy import error
 from fluenpy.output import ObjectBufferedOutput
 from fluenpy.plugin import Plugin
-from fluenpy.config import config_param
+from fluenpy.config import Configurable, config_param
+from base64 import b64encode
+import gevent
+from gevent.event import AsyncResult
+import gevent.select as select
 import gevent.socket as socket
+import math
 import msgpack
+import os
 import struct
+from collections import deque
+from time import time as now
 
 
 DEFAULT_LISTEN_PORT = 24224
 
+#: sendmsg 1回で渡すバッファの数の上限 (Linux の IOV_MAX).
+IOV_MAX = 1024
+
+
+def sendv(sock, buffers):
+    u"""
+    *buffers* を順に送る. ソケットが sendmsg を持っていれば
+    (Python 3.3 以降) コピーせずに1回のシステムコールでまとめて送る.
+    """
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        for b in buffers:
+            sock.sendall(b)
+        return
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    i = 0
+    while i < len(buffers):
+        n = sendmsg(buffers[i:i+IOV_MAX])
+        # 送れた分を飛ばす.
+        while n:
+            if n >= len(buffers[i]):
+                n -= len(buffers[i])
+                i += 1
+            else:
+                buffers[i] = buffers[i][n:]
+                n = 0
+
+
+class FailureDetector(object):
+    u"""
+    phi accrual failure detector.
+    ハートビートの到着間隔を正規分布とみなし、最後のハートビートから
+    経過した時間がどれだけ起こりにくいかを phi = -log10(確率) で表す.
+    """
+
+    #: 到着間隔を保持する数.
+    window_size = 100
+
+    #: phi の上限. 確率が浮動小数点数で表せないほど小さくても有限の値を返す.
+    max_phi = 100.0
+
+    def __init__(self, interval, t=None):
+        self.interval = interval
+        self._intervals = deque(maxlen=self.window_size)
+        # 1回目のハートビートまでは interval 毎に届く想定にする.
+        self._intervals.append(interval)
+        self.last = now() if t is None else t
+
+    def heartbeat(self, t=None):
+        if t is None:
+            t = now()
+        self._intervals.append(t - self.last)
+        self.last = t
+
+    def phi(self, t=None):
+        if t is None:
+            t = now()
+        n = len(self._intervals)
+        mean = sum(self._intervals) / n
+        var = sum((x - mean) ** 2 for x in self._intervals) / n
+        # 間隔が揃いすぎていると少し遅れただけで phi が跳ね上がるので、
+        # 標準偏差に下限を設ける.
+        stddev = max(math.sqrt(var), mean / 4, 1e-3)
+        p_later = 0.5 * math.erfc((t - self.last - mean) / (stddev * math.sqrt(2)))
+        if p_later <= 0:
+            return self.max_phi
+        return min(-math.log10(p_later), self.max_phi)
+
+
+class AckError(Exception):
+    pass
+
+
+class AckReader(object):
+    u"""
+    ack を待っているチャンクがある接続から応答を読み、待っている送信側に知らせる.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = {}   # チャンク ID => AsyncResult
+        self.closed = False
+        self._greenlet = gevent.spawn(self._run)
+
+    def expect(self, chunk_id):
+        result = self.pending[chunk_id] = AsyncResult()
+        return result
+
+    def _run(self):
+        unpacker = msgpack.Unpacker()
+        try:
+            while 1:
+                try:
+                    data = self.sock.recv(4096)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                unpacker.feed(data)
+                for res in unpacker:
+                    if not isinstance(res, dict):
+                        continue
+                    result = self.pending.pop(res.get(b'ack'), None)
+                    if result is not None:
+                        result.set()
+        except Exception as e:
+            log.debug("fail to read ack response: %s", e)
+        finally:
+            self.closed = True
+            for result in self.pending.values():
+                result.set_exception(AckError("connection is closed before ack"))
+            self.pending.clear()
+
+    def close(self):
+        self._greenlet.kill()
+
+
+class Node(object):
+    u"""
+    転送先のサーバー1台. 接続はプールして、複数のチャンクを順に送るのに使い回す.
+    ack を待つ場合も接続はすぐにプールに戻すので、1つの接続で複数のチャンクが
+    ack を待てる.
+    """
+
+    def __init__(self, host, port, connect_timeout=5, send_timeout=60,
+                 keepalive=True, keepalive_timeout=60, weight=60, standby=False,
+                 heartbeat_interval=1, ack_response_timeout=190):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.standby = standby
+        self.available = True
+        self.detector = FailureDetector(heartbeat_interval)
+        self._current_weight = 0
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.keepalive = keepalive
+        self.keepalive_timeout = keepalive_timeout
+        self.ack_response_timeout = ack_response_timeout
+        self._idle = []     # (ソケット, 最後に使った時刻)
+        self._readers = {}  # ソケット => AckReader
+        self.connect_count = self.send_count = self.error_count = 0
+        self.ack_timeout_count = 0
+
+    def __repr__(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+        sock.settimeout(self.send_timeout)
+        # ack を待つ間に Nagle で最後の断片が遅れないようにする.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect_count += 1
+        return sock
+
+    def _close(self, sock):
+        reader = self._readers.pop(sock, None)
+        if reader is not None:
+            reader.close()
+        sock.close()
+
+    def _alive(self, sock):
+        reader = self._readers.get(sock)
+        if reader is not None:
+            return not reader.closed
+        # 使っていない接続が読めるなら、相手が閉じたかエラーになっている.
+        try:
+            r, w, x = select.select([sock], [], [], 0)
+        except Exception:
+            return False
+        return not r
+
+    def _expired(self, sock, used, t):
+        reader = self._readers.get(sock)
+        return t - used >= self.keepalive_timeout and not (reader and reader.pending)
+
+    def acquire(self):
+        u"""
+        プールから接続を取り出す. 使える接続が無ければ新しく接続する.
+        2番目の戻り値はプールから取り出した接続かどうか.
+        """
+        t = now()
+        while self._idle:
+            sock, used = self._idle.pop()
+            if not self._expired(sock, used, t) and self._alive(sock):
+                return sock, True
+            self._close(sock)
+        return self._connect(), False
+
+    def release(self, sock):
+        if self.keepalive:
+            self._idle.append((sock, now()))
+        else:
+            self._close(sock)
+
+    def close_idle(self, force=False):
+        u"""keepalive_timeout を過ぎた接続を閉じる. *force* なら全て閉じる."""
+        t = now()
+        idle = []
+        for sock, used in self._idle:
+            if force or self._expired(sock, used, t):
+                self._close(sock)
+            else:
+                idle.append((sock, used))
+        self._idle = idle
+
+    def send(self, buffers, chunk_id=None):
+        u"""
+        *buffers* を送る. *chunk_id* があれば、その ack が返るまで待つ.
+        """
+        while 1:
+            sock, reused = self.acquire()
+            result = None
+            if chunk_id is not None:
+                reader = self._readers.get(sock)
+                if reader is None:
+                    reader = self._readers[sock] = AckReader(sock)
+                result = reader.expect(chunk_id)
+            try:
+                sendv(sock, buffers)
+            except Exception:
+                self._close(sock)
+                if reused:
+                    # プールしていた接続が切れていたら繋ぎ直す.
+                    continue
+                self.error_count += 1
+                raise
+            self.send_count += 1
+            if result is None or self.keepalive:
+                self.release(sock)
+            if result is not None:
+                self._wait_ack(sock, result)
+            return
+
+    def _wait_ack(self, sock, result):
+        try:
+            result.get(timeout=self.ack_response_timeout)
+        except gevent.Timeout:
+            self.ack_timeout_count += 1
+            self.error_count += 1
+            # 届いたかどうか分からないので、この接続は使わない.
+            self._close(sock)
+            raise AckError("ack response timed out")
+        except AckError:
+            self.error_count += 1
+            raise
+        finally:
+            if not self.keepalive:
+                self._close(sock)
+
+    def metrics(self):
+        return dict(connect_count=self.connect_count,
+                    send_count=self.send_count,
+                    error_count=self.error_count,
+                    idle_connections=len(self._idle),
+                    ack_timeout_count=self.ack_timeout_count,
+                    pending_acks=sum(len(r.pending) for r in self._readers.values()),
+                    available=int(self.available),
+                    phi=self.detector.phi(),
+                    weight=self.weight,
+                    standby=int(self.standby))
+
+
+def chunk_id(chunk):
+    u"""
+    ack に使う *chunk* の id を返す. リトライしても同じ id を使うので、
+    受信側は同じチャンクの再送を見分けられる.
+    """
+    id = getattr(chunk, 'forward_chunk_id', None)
+    if id is None:
+        unique_id = getattr(chunk, 'unique_id', None)
+        # ファイルバッファのチャンクなら再起動後も同じ id になる.
+        raw = unique_id.encode('ascii') if unique_id else os.urandom(16)
+        id = chunk.forward_chunk_id = b64encode(raw)
+    return id
+
+
+def weighted_order(nodes):
+    u"""
+    smooth weighted round robin で *nodes* から1台選び、それを先頭にして
+    残りを続けたリストを返す. weight が 0 のノードは含まない.
+    """
+    nodes = [n for n in nodes if n.weight > 0]
+    if not nodes:
+        return []
+    total = 0
+    best = None
+    for n in nodes:
+        n._current_weight += n.weight
+        total += n.weight
+        if best is None or n._current_weight > best._current_weight:
+            best = n
+    best._current_weight -= total
+    return [best] + [n for n in nodes if n is not best]
+
+
+class _ServerConfig(Configurable):
+    u"""``<server>`` の設定."""
+
+    host = config_param('string')
+    port = config_param('integer', DEFAULT_LISTEN_PORT)
+    #: 他のサーバーに対する振り分けの比率.
+    weight = config_param('integer', 60)
+    #: 他のサーバーが全て使えない時だけ使う.
+    standby = config_param('bool', False)
+
 
 class ForwardOutput(ObjectBufferedOutput):
 
+    connect_timeout = config_param('time', 5)
+    send_timeout = config_param('time', 60)
+    #: 送信に使った接続を閉じずに次のチャンクにも使う.
+    keepalive = config_param('bool', True)
+    #: この時間使わなかった接続は閉じる.
+    keepalive_timeout = config_param('time', 60)
+    #: udp ならハートビートで死活を監視する. none なら監視しない.
+    #: UDP が届かない環境ではサーバーが切り離されたままになるので、既定は none.
+    heartbeat_type = config_param('string', 'none')
+    heartbeat_interval = config_param('time', 1)
+    #: phi がこれを超えたサーバーには送らない.
+    phi_threshold = config_param('float', 16)
+    #: 受信側がチャンクをバッファに入れたことを ack で確認する.
+    require_ack_response = config_param('bool', False)
+    #: ack がこの時間内に返らなければ送信に失敗したとみなす.
+    ack_response_timeout = config_param('time', 190)
+
+    #: require_ack_response で num_threads を指定しなかった時のワーカーの数.
+    #: ワーカーは ack を待つ間は次のチャンクを送らないので、これが ack を
+    #: 待てるチャンクの数になる.
+    ack_num_threads = 8
+
     def __init__(self):
         super(ForwardOutput, self).__init__()
         self._nodes = []
+        self._heartbeat_addrs = {}
 
     def configure(self, conf):
         super(ForwardOutput, self).configure(conf)
+        if self.heartbeat_type not in ('udp', 'none'):
+            raise error.ConfigError("heartbeat_type must be udp or none: %r" %
+                                    (self.heartbeat_type,))
+        if (self.require_ack_response and 'num_threads' not in conf and
+                'flush_thread_count' not in conf):
+            self.num_threads = self.ack_num_threads
 
         for e in conf.elements:
             if e.name != "server":
                 continue
-            host = e['host']
-            port = int(e.get('port', DEFAULT_LISTEN_PORT))
-            self._nodes.append((host, port))
-            log.info("adding forwarding server %s:%s", host, port)
+            server = _ServerConfig()
+            server.configure(e)
+            self._nodes.append(Node(server.host, server.port,
+                                    self.connect_timeout, self.send_timeout,
+                                    self.keepalive, self.keepalive_timeout,
+                                    server.weight, server.standby,
+                                    self.heartbeat_interval,
+                                    self.ack_response_timeout))
+            log.info("adding forwarding server %s:%s weight=%d%s", server.host,
+                     server.port, server.weight, " (standby)" if server.standby else "")
+
+    def start(self):
+        super(ForwardOutput, self).start()
+        self._maintainer = gevent.spawn(self.maintain)
+        self._heartbeat = None
+        if self.heartbeat_type == 'udp':
+            for node in self._nodes:
+                node.detector.last = now()
+            self._heartbeat_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._heartbeat = [gevent.spawn(self.send_heartbeats),
+                               gevent.spawn(self.receive_heartbeats)]
+
+    def send_heartbeats(self):
+        while not self._shutdown:
+            for node in self._nodes:
+                try:
+                    addr = (socket.gethostbyname(node.host), node.port)
+                    self._heartbeat_addrs[addr] = node
+                    self._heartbeat_sock.sendto(b'', addr)
+                except Exception as e:
+                    log.debug("fail to send heartbeat to %s: %s", node, e)
+            gevent.sleep(self.heartbeat_interval)
+            t = now()
+            for node in self._nodes:
+                if node.available and node.detector.phi(t) > self.phi_threshold:
+                    log.warn("detached forwarding server %s (phi=%s)",
+                             node, node.detector.phi(t))
+                    node.available = False
+
+    def receive_heartbeats(self):
+        while 1:
+            data, addr = self._heartbeat_sock.recvfrom(1024)
+            node = self._heartbeat_addrs.get(addr)
+            if node is None:
+                continue
+            node.detector.heartbeat()
+            if not node.available:
+                log.info("recovered forwarding server %s", node)
+                node.available = True
+
+    def maintain(self):
+        while not self._shutdown:
+            gevent.sleep(1)
+            for node in self._nodes:
+                node.close_idle()
+
+    def shutdown(self):
+        super(ForwardOutput, self).shutdown()
+        self._maintainer.kill()
+        if self._heartbeat:
+            gevent.killall(self._heartbeat)
+            self._heartbeat_sock.close()
+        for node in self._nodes:
+            node.close_idle(force=True)
+
+    def metrics(self):
+        m = super(ForwardOutput, self).metrics()
+        m['nodes'] = dict((repr(node), node.metrics()) for node in self._nodes)
+        return m
+
+    def forward_nodes(self):
+        return self._nodes
 
     def write(self, chunk):
         key = chunk.key
-        data = chunk.read()
-        log.debug("sending tag=%s data=%dbytes", key, len(data))
-        for node in self._nodes:
+        option = None
+        if chunk.compressed:
+            # 圧縮したまま CompressedPackedForward で送る.
+            segments = chunk.raw_segments()
+            option = {'compressed': 'gzip'}
+            if chunk.records:
+                option['size'] = chunk.records
+        else:
+            segments = chunk.segments()
+        if self.require_ack_response:
+            option = option or {}
+            option['chunk'] = chunk_id(chunk)
+        log.debug("sending tag=%s data=%dbytes", key, len(chunk))
+        for node in self.select_nodes():
             try:
-                self.send_data(node, key, data)
+                self.send_data(node, key, segments, option)
                 break
             except Exception as e:
                 log.warn("fail to send data to %s: %s", node, e)
-                pass
+                if self.heartbeat_type != 'none':
+                    # 次のハートビートが届くまで使わない.
+                    node.available = False
         else:
             raise Exception("No nodes are available.")
 
-    def send_data(self, node, tag, data):
-        sock = socket.socket()
-        header = b"\x92" + msgpack.packb(tag) + b"\xdb" + struct.pack("!L", len(data))
-        sock.connect(node)
-        try:
-            sock.sendall(header)
-            sock.sendall(data)
-        finally:
-            sock.close()
+    def select_nodes(self):
+        u"""送信を試すノードを順に返す. 先頭は weight に従って振り分ける."""
+        available = [n for n in self._nodes if n.available]
+        return (weighted_order([n for n in available if not n.standby]) +
+                weighted_order([n for n in available if n.standby]))
+
+    def send_data(self, node, tag, segments, option=None):
+        size = sum(map(len, segments))
+        header = ((b"\x93" if option else b"\x92") + msgpack.packb(tag) +
+                  b"\xdb" + struct.pack("!L", size))
+        buffers = [header] + segments
+        if option:
+            buffers.append(msgpack.packb(option))
+        node.send(buffers, option and option.get('chunk'))
 
 Plugin.register_output('forward', ForwardOutput)
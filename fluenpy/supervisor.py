@@ -9,14 +9,110 @@
 
 from __future__ import print_function, division, absolute_import
 
+import errno
+import logging
+import os
+import signal
+import time
+
+import gevent
 from fluenpy.engine import Engine
 
+log = logging.getLogger(__name__)
+
+# 起動してからこの秒数以内に死んだワーカーは、再起動する前に RESTART_WAIT 秒待つ.
+MIN_LIFETIME = 10
+RESTART_WAIT = 5
+
+
 class Supervisor(object):
     def __init__(self, opts):
         self._opts = opts
         self._finished = False
+        self._workers = {}      # pid => (worker_id, started)
+        self._restart = {}      # worker_id => time to restart
 
     def start(self):
-        #todo: supervise
-        Engine.read_config(self._opts.config)
-        Engine.run()
+        workers = getattr(self._opts, 'workers', 1) or 1
+        if workers <= 1:
+            Engine.read_config(self._opts.config)
+            Engine.run()
+            return
+        self.supervise(workers)
+
+    def supervise(self, workers):
+        u"""*workers* 個のエンジンプロセスを fork して、死んだら再起動する."""
+        for sig in (signal.SIGABRT, signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(sig, self._on_signal)
+
+        for worker_id in range(workers):
+            self._spawn(worker_id, workers)
+
+        while self._workers or (self._restart and not self._finished):
+            time.sleep(1)
+            self._reap()
+            if self._finished:
+                continue
+            t = time.time()
+            for worker_id, restart_at in list(self._restart.items()):
+                if restart_at <= t:
+                    del self._restart[worker_id]
+                    self._spawn(worker_id, workers)
+        log.info("all workers are finished.")
+
+    def _on_signal(self, sig, frame):
+        if sig != signal.SIGHUP:
+            self._finished = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self._workers.clear()
+                    return
+                raise
+            if not pid:
+                return
+            worker_id, started = self._workers.pop(pid)
+            if self._finished:
+                log.info("worker %d (pid=%d) is finished.", worker_id, pid)
+                continue
+            log.warn("worker %d (pid=%d) died unexpectedly. status=%d",
+                     worker_id, pid, status)
+            t = time.time()
+            if t - started < MIN_LIFETIME:
+                self._restart[worker_id] = t + RESTART_WAIT
+            else:
+                self._restart[worker_id] = t
+
+    def _spawn(self, worker_id, workers):
+        pid = os.fork()
+        if pid:
+            log.info("started worker %d (pid=%d)", worker_id, pid)
+            self._workers[pid] = (worker_id, time.time())
+            return
+
+        status = 1
+        try:
+            for sig in (signal.SIGABRT, signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+            gevent.reinit()
+            Engine.worker_id = worker_id
+            Engine.workers = workers
+            Engine.read_config(self._opts.config)
+            Engine.run()
+            status = 0
+        except BaseException:
+            log.exception("worker %d is crashed.", worker_id)
+        finally:
+            os._exit(status)
@@ -0,0 +1,11 @@
+from fluenpy import bench
+
+
+def test_run():
+    report = bench.run(['parser.json', 'routing', 'match', 'pack', 'buffer'], events=100, batch=10)
+    assert sorted(report['stages']) == ['buffer', 'match.scan', 'match.trie', 'pack', 'parser.json',
+                                         'routing']
+    for result in report['stages'].values():
+        assert result['events'] == 100
+        assert result['batches'] == 10
+        assert result['latency_p50'] <= result['latency_p99']
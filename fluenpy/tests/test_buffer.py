@@ -0,0 +1,261 @@
+from fluenpy.error import BufferQueueLimitError, BufferTotalLimitError
+from fluenpy.plugins.buf_memory import MemoryBuffer
+import gevent
+import zlib
+import pytest
+
+
+def make_buffer(**conf):
+    buf = MemoryBuffer()
+    buf.configure(dict((k, str(v)) for k, v in conf.items()))
+    buf.start()
+    return buf
+
+
+def test_queue_limit_rejects_data():
+    buf = make_buffer(buffer_chunk_limit=10, buffer_queue_limit=1)
+    buf.emit('k', b'a' * 8)
+    buf.emit('k', b'b' * 8)
+    with pytest.raises(BufferQueueLimitError):
+        buf.emit('k', b'c' * 8)
+    assert buf._map['k'].read() == b'b' * 8
+    assert buf.get_nowait().read() == b'a' * 8
+
+    buf.emit('k', b'c' * 8)
+    assert buf._map['k'].read() == b'c' * 8
+
+
+def test_file_buffer_resume(tmpdir):
+    from fluenpy.plugins.buf_file import FileBuffer
+
+    path = str(tmpdir.join('buf', 'out'))
+    conf = {'buffer_path': path, 'buffer_chunk_limit': '10'}
+    buf = FileBuffer()
+    buf.configure(conf)
+    buf.start()
+    buf.emit('a.b', b'1' * 8)
+    buf.emit('a.b', b'2' * 8)
+    buf.emit('a/c', b'3' * 8)
+    assert len(tmpdir.join('buf').listdir('*.log')) == 3
+
+    # restart without shutdown (e.g. crash)
+    buf2 = FileBuffer()
+    buf2.configure(conf)
+    buf2.start()
+    assert sorted(buf2.keys()) == ['a.b', 'a/c']
+    assert buf2._map['a.b'].read() == b'2' * 8
+    chunk = buf2.get_nowait()
+    assert chunk.key == 'a.b'
+    f = chunk.open()
+    assert f.read() == b'1' * 8
+    f.close()
+    chunk.purge()
+    assert len(tmpdir.join('buf').listdir('*.log')) == 2
+
+    buf2.emit('a/c', b'4')
+    assert buf2._map['a/c'].read() == b'3' * 8 + b'4'
+
+
+def test_file_buffer_resume_keeps_queue_limit(tmpdir):
+    from fluenpy.plugins.buf_file import FileBuffer
+
+    conf = {'buffer_path': str(tmpdir.join('out')), 'buffer_chunk_limit': '1',
+            'buffer_queue_limit': '8'}
+    buf = FileBuffer()
+    buf.configure(conf)
+    buf.start()
+    for i in range(6):
+        buf.emit('k', str(i).encode('ascii'))
+
+    conf['buffer_queue_limit'] = '2'
+    buf2 = FileBuffer()
+    buf2.configure(conf)
+    buf2.start()
+    assert buf2._queue.maxsize == 2
+    assert buf2.metrics()['buffer_queue_length'] == 5
+    with pytest.raises(BufferQueueLimitError):
+        buf2.emit('k', b'x')
+    assert [buf2.get_nowait().read() for i in range(5)] == [b'0', b'1', b'2', b'3', b'4']
+
+
+def test_file_buffer_path_per_worker(tmpdir, monkeypatch):
+    from fluenpy.engine import Engine
+    from fluenpy.plugins.buf_file import FileBuffer
+
+    monkeypatch.setattr(Engine, 'workers', 2)
+    monkeypatch.setattr(Engine, 'worker_id', 1)
+    buf = FileBuffer()
+    buf.configure({'buffer_path': str(tmpdir.join('out'))})
+    buf.start()
+    buf.emit('k', b'x')
+    assert len(tmpdir.join('worker1').listdir('out.*.log')) == 1
+
+    spill = make_buffer(overflow_action='spill_to_disk',
+                        spill_path=str(tmpdir.join('spill')))
+    assert spill._spill.buffer_path == str(tmpdir.join('worker1', 'spill'))
+
+
+@pytest.fixture
+def budget(request):
+    from fluenpy.buffer import MemoryBudget
+    request.addfinalizer(lambda: MemoryBudget.configure(0))
+    MemoryBudget.usage = 0
+    MemoryBudget._buffers.clear()
+    return MemoryBudget
+
+
+def test_total_limit_reject(budget):
+    budget.configure(20, 'reject')
+    buf = make_buffer(buffer_chunk_limit=10)
+    buf.emit('k', b'a' * 8)
+    buf.emit('k', b'b' * 8)
+    with pytest.raises(BufferTotalLimitError):
+        buf.emit('k', b'c' * 8)
+    assert budget.usage == 16
+
+    buf.purge(buf.get_nowait())
+    assert budget.usage == 8
+    buf.emit('k', b'c' * 8)
+    assert budget.usage == 16
+
+
+def test_total_limit_drop_oldest(budget):
+    budget.configure(20, 'drop_oldest')
+    buf1 = make_buffer(buffer_chunk_limit=10)
+    buf2 = make_buffer(buffer_chunk_limit=10)
+    buf1.emit('k', b'a' * 8)
+    buf1.emit('k', b'b' * 8)    # 'a' is queued
+    buf2.emit('k', b'c' * 8)    # drops 'a'
+    assert buf1.peek() is None
+    assert budget.usage == 16
+    assert budget.dropped_chunks == 1
+
+
+def test_overflow_drop_oldest_chunk():
+    buf = make_buffer(buffer_chunk_limit=10, buffer_queue_limit=1,
+                      overflow_action='drop_oldest_chunk')
+    for c in [b'a', b'b', b'c']:
+        buf.emit('k', c * 8)
+    assert buf.get_nowait().read() == b'b' * 8
+    assert buf.dropped_chunks == 1
+    assert buf.dropped_bytes == 8
+
+
+def test_overflow_block_timeout():
+    buf = make_buffer(buffer_chunk_limit=10, buffer_queue_limit=1,
+                      overflow_action='block', overflow_timeout=0.01)
+    buf.emit('k', b'a' * 8)
+    buf.emit('k', b'b' * 8)
+    with pytest.raises(BufferQueueLimitError):
+        buf.emit('k', b'c' * 8)
+    assert buf.blocked_count == 1
+
+    gevent.spawn_later(0.001, buf.get_nowait)
+    buf.overflow_timeout = 1
+    buf.emit('k', b'c' * 8)
+    assert buf.get_nowait().read() == b'b' * 8
+
+
+def test_overflow_spill_to_disk(tmpdir):
+    buf = make_buffer(buffer_chunk_limit=10, buffer_queue_limit=1,
+                      overflow_action='spill_to_disk',
+                      spill_path=str(tmpdir.join('spill')))
+    for c in [b'a', b'b', b'c', b'd']:
+        buf.emit('k', c * 8)
+    assert buf.spilled_chunks == 2
+    assert len(tmpdir.listdir('*.log')) == 2
+
+    for c in [b'a', b'b', b'c']:
+        chunk = buf.get_nowait()
+        assert chunk.read() == c * 8
+        buf.purge(chunk)
+    assert len(tmpdir.listdir()) == 0
+    assert buf._map['k'].read() == b'd' * 8
+
+
+def test_memory_chunk_segments():
+    from fluenpy.plugins.buf_memory import MemoryBufferChunk, SEGMENT_SIZE
+
+    big = b'x' * SEGMENT_SIZE
+    chunk = MemoryBufferChunk('k', 0)
+    chunk += b'a'
+    chunk += b'b'
+    chunk += big
+    chunk += b'c'
+    segments = chunk.segments()
+    assert segments == [b'ab', big, b'c']
+    assert segments[1] is big
+    assert len(chunk) == SEGMENT_SIZE + 3
+    assert chunk.read() == b'ab' + big + b'c'
+
+
+def test_flush_scheduler():
+    from fluenpy.buffer import FlushScheduler
+
+    buf = make_buffer(buffer_chunk_limit=10, flush_interval=0.01)
+    skipped = FlushScheduler.skipped
+    buf.emit('a', b'a' * 8)
+    buf.emit('a', b'b' * 8)     # 'a' is queued by size
+    buf.emit('b', b'c' * 8)
+    assert buf._queue.qsize() == 1
+    gevent.sleep(0.05)
+    assert buf._map == {}
+    assert [buf.get_nowait().read() for _ in range(3)] == [b'a' * 8, b'b' * 8, b'c' * 8]
+    assert FlushScheduler.skipped == skipped + 1
+
+
+def test_chunk_records_limit_and_metadata(tmpdir):
+    from fluenpy.plugins.buf_file import FileBuffer
+
+    buf = FileBuffer()
+    buf.configure({'buffer_path': str(tmpdir.join('out')),
+                   'buffer_chunk_records_limit': '3'})
+    buf.start()
+    buf.emit('k', b'ab', records=2, time_range=(20, 30))
+    buf.emit('k', b'c', records=1, time_range=(10, 10))
+    buf.emit('k', b'd', records=1, time_range=(40, 40))
+    chunk = buf.peek()
+    assert chunk.read() == b'abc'
+    assert (chunk.records, chunk.first_time, chunk.last_time) == (3, 10, 30)
+
+    buf2 = FileBuffer()
+    buf2.configure({'buffer_path': str(tmpdir.join('out'))})
+    buf2.start()
+    meta = buf2.peek().metadata()
+    assert (meta['records'], meta['first_time'], meta['last_time']) == (3, 10, 30)
+    assert meta['created_at'] == chunk.created_at
+
+
+def test_flush_mode():
+    buf = make_buffer(flush_mode='immediate')
+    buf.emit('k', b'a')
+    buf.emit('k', b'b')
+    assert [buf.get_nowait().read() for _ in range(2)] == [b'a', b'b']
+
+    buf = make_buffer(flush_mode='lazy', flush_interval=0)
+    buf.emit('k', b'a')
+    gevent.sleep(0.01)
+    assert buf.peek() is None
+    buf.shutdown()
+    assert buf.peek().read() == b'a'
+
+
+@pytest.mark.parametrize('type_', ['memory', 'file'])
+def test_compress_gzip(type_, tmpdir):
+    from fluenpy.plugin import Plugin
+
+    Plugin.load_plugins()
+    buf = Plugin.new_buffer(type_)
+    buf.configure({'compress': 'gzip', 'buffer_chunk_limit': '1k',
+                   'buffer_path': str(tmpdir.join('out'))})
+    buf.start()
+    data = b'0123456789' * 50
+    buf.emit('k', data)
+    buf.emit('k', data)
+    buf.flush()
+    chunk = buf.get_nowait()
+    assert chunk.compressed
+    assert len(chunk) < len(data)
+    assert chunk.read() == data * 2
+    assert chunk.open().read(10) == data[:10]
+    assert zlib.decompress(chunk.raw_read(), 16 + zlib.MAX_WBITS) == data * 2
@@ -0,0 +1,27 @@
+from fluenpy.cache import ClockCache
+
+
+def test_clock_cache():
+    c = ClockCache(2)
+    assert c.get('a') is None
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    c.put('c', 3)   # 'b' is not referenced since insertion.
+    assert c.get('b') is None
+    assert c.get('a') == 1
+    assert c.get('c') == 3
+    assert len(c) == 2
+    assert c.stats() == dict(size=2, capacity=2, hits=3, misses=2, evictions=1)
+
+    c.clear()
+    assert len(c) == 0
+    assert c.get('a') is None
+    assert c.misses == 3
+
+
+def test_clock_cache_disabled():
+    c = ClockCache(0)
+    c.put('a', 1)
+    assert c.get('a') is None
+    assert len(c) == 0
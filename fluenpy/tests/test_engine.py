@@ -0,0 +1,214 @@
+from fluenpy import config
+from fluenpy.engine import EngineClass
+from fluenpy.filter import Filter
+from fluenpy.output import Output
+from fluenpy.plugin import Plugin
+import io
+import socket
+
+
+class CaptureOutput(Output):
+    def __init__(self):
+        self.events = []
+
+    def emit(self, tag, es):
+        self.events.extend((tag, t, r) for t, r in es)
+
+
+class AddFilter(Filter):
+    def configure(self, conf):
+        self.key = conf['key']
+
+    def filter(self, tag, time, record):
+        record = dict(record)
+        record[self.key] = True
+        return record
+
+
+Plugin.register_output('test_capture', CaptureOutput)
+Plugin.register_filter('test_add', AddFilter)
+
+
+def make_engine(conf):
+    engine = EngineClass()
+    engine.parse_config(io.BytesIO(conf), "test.conf", None)
+    return engine
+
+
+def test_filter_chain():
+    engine = make_engine("""
+<filter app.**>
+  type test_add
+  key f1
+</filter>
+<filter app.debug>
+  type grep
+  exclude1 message ^drop
+</filter>
+<match app.**>
+  type test_capture
+</match>
+<filter **>
+  type test_add
+  key never
+</filter>
+<match **>
+  type test_capture
+</match>
+""")
+    app, other = [m.output for m in engine._matches]
+
+    engine.emit_stream('app.debug', [(1, {'message': 'keep'}),
+                                     (2, {'message': 'drop me'})])
+    engine.emit('app.info', 3, {'message': 'drop'})
+    engine.emit('other', 4, {})
+
+    assert app.events == [
+        ('app.debug', 1, {'message': 'keep', 'f1': True}),
+        ('app.info', 3, {'message': 'drop', 'f1': True}),
+        ]
+    assert other.events == [('other', 4, {'never': True})]
+
+
+def test_grep_non_ascii():
+    engine = make_engine("""
+<filter **>
+  type grep
+  regexp1 message ^error
+  exclude1 code ^5
+</filter>
+<match **>
+  type test_capture
+</match>
+""")
+    out = engine._matches[0].output
+    engine.emit('a', 1, {'message': u'error \u3042', 'code': 404})
+    engine.emit('a', 2, {'message': u'info \u3042'})
+    engine.emit('a', 3, {'message': u'error', 'code': 503})
+    assert out.events == [('a', 1, {'message': u'error \u3042', 'code': 404})]
+
+
+def test_single_worker_source_on_other_workers():
+    engine = EngineClass()
+    engine.worker_id = 1
+    conf = config.parse(io.BytesIO("""
+<source>
+  type monitor_agent
+  port 24220
+</source>
+<match **>
+  type null
+</match>
+"""), "test.conf")
+    engine.configure(conf)
+    assert engine._sources == []
+    assert conf.not_fetched() == []
+
+
+def test_match_cache_invalidated():
+    engine = make_engine("""
+<system>
+  match_cache_size 1
+</system>
+<match **>
+  type test_capture
+</match>
+""")
+    engine.emit('a', 1, {})
+    engine.emit('a', 2, {})
+    engine.emit('b', 3, {})
+    assert engine.match_cache_stats()['evictions'] == 1
+    assert engine.match_cache_stats()['hits'] == 1
+
+    conf = config.parse(io.BytesIO("<match **>\n type null\n</match>\n"), "test.conf")
+    engine.configure(conf)
+    assert len(engine._match_cache) == 0
+
+
+def test_reload(tmpdir):
+    path = tmpdir.join('fluent.conf')
+    path.write("""
+<match a.**>
+  type test_capture
+</match>
+<match b.**>
+  type test_capture
+  tag_b 1
+</match>
+""")
+    engine = EngineClass()
+    engine.read_config(str(path))
+    a, b = [m.output for m in engine._matches]
+    engine.emit('a.x', 1, {})
+
+    path.write("""
+<filter **>
+  type test_add
+  key reloaded
+</filter>
+<match a.x>
+  type test_capture
+</match>
+<match b.**>
+  type test_capture
+  tag_b 2
+</match>
+""")
+    engine.reload()
+    a2, b2 = [m.output for m in engine._matches]
+    assert a2 is a
+    assert b2 is not b
+    engine.emit('a.x', 2, {})
+    assert a.events == [('a.x', 1, {}), ('a.x', 2, {'reloaded': True})]
+
+    path.write("<match **>\n  type no_such_plugin\n</match>\n")
+    engine.reload()
+    assert engine._matches[0].output is a
+
+
+def test_reload_rollback(tmpdir):
+    path = tmpdir.join('fluent.conf')
+    path.write("<match **>\n  type test_capture\n</match>\n")
+    engine = EngineClass()
+    engine.read_config(str(path))
+    out = engine._matches[0].output
+
+    # the system settings stay when the new config fails to build
+    path.write("""
+<system>
+  match_cache_size 5
+</system>
+<match **>
+  type no_such_plugin
+</match>
+""")
+    engine.reload()
+    assert engine.system.match_cache_size == 1024
+    assert engine._matches[0].output is out
+
+    # the new source cannot bind a port which is already in use
+    busy = socket.socket()
+    busy.bind(('127.0.0.1', 0))
+    busy.listen(1)
+    path.write("""
+<system>
+  match_cache_size 5
+</system>
+<source>
+  type forward
+  bind 127.0.0.1
+  port %d
+</source>
+<match **>
+  type test_capture
+  changed 1
+</match>
+""" % (busy.getsockname()[1],))
+    engine.reload()
+    busy.close()
+    assert engine.system.match_cache_size == 1024
+    assert engine._match_cache.capacity == 1024
+    assert engine._matches[0].output is out
+    assert engine._sources == []
+    engine.emit('a', 1, {})
+    assert out.events == [('a', 1, {})]
@@ -0,0 +1,51 @@
+from fluenpy.event import *
+import msgpack
+import struct
+import zlib
+
+
+def _check(es, entries):
+    assert len(es) == len(entries)
+    assert [tuple(e) for e in es] == entries
+    assert [tuple(e) for e in es] == entries  # repeatable
+    assert [tuple(e) for e in es[1:]] == entries[1:]
+    assert isinstance(es[:1], EventStream)
+    mpac = es.to_mpac()
+    assert mpac == b''.join(map(msgpack.packb, entries))
+    assert es.to_mpac() is mpac
+    times = [t for t, r in entries]
+    assert es.time_range() == (min(times), max(times))
+
+
+def test_array_event_stream():
+    entries = [(1, {'a': 1}), (2, {'b': 2}), (3, {'c': 3})]
+    _check(ArrayEventStream(entries), entries)
+
+
+def test_one_event_stream():
+    _check(OneEventStream(1, {'a': 1}), [(1, {'a': 1})])
+
+
+def test_msgpack_event_stream():
+    entries = [(1, {'a': 1}), (2, {'b': 2}), (3, {'c': 3})]
+    data = b''.join(map(msgpack.packb, entries))
+    _check(MessagePackEventStream(data), entries)
+    assert len(MessagePackEventStream(data, size=3)) == 3
+
+
+def test_compressed_msgpack_event_stream():
+    entries = [(1, {'a': 1}), (2, {'b': 2}), (3, {'c': 3})]
+    data = b''.join(map(msgpack.packb, entries))
+    c = zlib.compressobj(9, zlib.DEFLATED, 31)
+    compressed = c.compress(data) + c.flush()
+    es = CompressedMessagePackEventStream(compressed)
+    assert es.time_range() == (1, 3)
+    assert es.compressed_mpac() is compressed
+    _check(es, entries)
+
+
+def test_event_time():
+    t = msgpack.ExtType(0, struct.pack('!LL', 1, 500000000))
+    es = MessagePackEventStream(msgpack.packb([t, {'a': 1}]))
+    assert [tuple(e) for e in es] == [(1.5, {'a': 1})]
+    assert es.time_range() == (1.5, 1.5)
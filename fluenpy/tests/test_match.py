@@ -9,3 +9,54 @@ def test_match():
     assert not m.match('bar')
     assert not m.match('fooo.xxx')
     assert m.match('fooo.bar')
+
+
+def test_match_segments():
+    m = Match("a.** **.z x.*.y", None)
+    assert m.match('a')
+    assert m.match('a.b.c')
+    assert not m.match('ab')
+    assert m.match('z')
+    assert m.match('q.r.z')
+    assert m.match('x.foo.y')
+    assert not m.match('x.foo.bar.y')
+    assert not m.match('x.y')
+
+
+def test_trie_first_match_wins():
+    m1 = Match("foo.bar", 1)
+    m2 = Match("foo.*", 2)
+    m3 = Match("**", 3)
+    trie = MatchTrie([m1, m2, m3])
+    assert trie.match('foo.bar') is m1
+    assert trie.match('foo.baz') is m2
+    assert trie.match('foo') is m3
+    assert trie.match('foo.bar.baz') is m3
+
+    trie = MatchTrie([m3, m1, m2])
+    assert trie.match('foo.bar') is m3
+
+
+def test_trie_same_as_scan():
+    patterns = [
+        "a.b", "a.*", "*.b", "a.**", "**.c", "a.**.c", "a?.b[0-9]",
+        "x*.y", "[!a].b", "**.**", "a.*.*", "b.c.**",
+        ]
+    matches = [Match(p, p) for p in patterns]
+    segs = ['a', 'b', 'c', 'a1', 'xx', 'b3', 'x']
+    tags = set(segs)
+    for s1 in segs:
+        for s2 in segs:
+            tags.add(s1 + '.' + s2)
+            for s3 in segs:
+                tags.add('.'.join((s1, s2, s3)))
+    for i in range(len(matches)):
+        ms = matches[i:] + matches[:i]
+        trie = MatchTrie(ms)
+        for tag in tags:
+            expected = None
+            for m in ms:
+                if m.match(tag):
+                    expected = m
+                    break
+            assert trie.match(tag) is expected, tag
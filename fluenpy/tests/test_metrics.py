@@ -0,0 +1,32 @@
+from fluenpy.metrics import Histogram, to_json_value, to_prometheus
+
+
+def test_histogram():
+    h = Histogram((0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 2.0):
+        h.observe(v)
+    assert h.cumulative() == [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+    assert to_json_value({'h': h, 'n': 1}) == {
+        'h': {'count': 4, 'sum': 2.65, 'buckets': [[0.1, 2], [1.0, 3]]},
+        'n': 1,
+        }
+
+
+def test_prometheus():
+    h = Histogram((1.0,))
+    h.observe(0.5)
+    text = to_prometheus([
+        ('fluenpy_output', {'plugin_id': 'a'}, {'emit_count': 3, 'lat': h,
+                                                'next_retry_time': None}),
+        ('fluenpy_output', {'plugin_id': 'b'}, {'emit_count': 4}),
+        ])
+    assert text.splitlines() == [
+        '# TYPE fluenpy_output_emit_count gauge',
+        'fluenpy_output_emit_count{plugin_id="a"} 3',
+        'fluenpy_output_emit_count{plugin_id="b"} 4',
+        '# TYPE fluenpy_output_lat histogram',
+        'fluenpy_output_lat_bucket{le="1.0",plugin_id="a"} 1',
+        'fluenpy_output_lat_bucket{le="+Inf",plugin_id="a"} 1',
+        'fluenpy_output_lat_sum{plugin_id="a"} 0.5',
+        'fluenpy_output_lat_count{plugin_id="a"} 1',
+        ]
@@ -0,0 +1,303 @@
+from fluenpy import config
+from fluenpy.event import ArrayEventStream, OneEventStream
+from fluenpy.plugin import Plugin
+from fluenpy.plugins.in_forward import ForwardInput
+from fluenpy.plugins.out_forward import AckError, FailureDetector, sendv
+import gevent
+import gevent.socket as socket
+import io
+import msgpack
+import pytest
+import struct
+import zlib
+
+
+class PartialSocket(object):
+    """Socket whose sendmsg sends at most 3 bytes at once."""
+
+    def __init__(self):
+        self.sent = b''
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(b.tobytes() for b in buffers)[:3]
+        self.sent += data
+        return len(data)
+
+
+def test_sendv_partial():
+    sock = PartialSocket()
+    sendv(sock, [b'ab', b'', b'cdefg', b'h'])
+    assert sock.sent == b'abcdefgh'
+    assert sock.calls == 3
+
+
+class CaptureInput(ForwardInput):
+    def __init__(self):
+        super(CaptureInput, self).__init__()
+        self.received = []
+
+    def emit_stream(self, tag, es, block=True):
+        self.received.append((tag, len(es), [tuple(e) for e in es]))
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_input(port=None, **conf):
+    # the heartbeat server listens on the same port number over UDP
+    port = port or free_port()
+    in_ = CaptureInput()
+    conf.update(bind='127.0.0.1', port=str(port))
+    in_.configure(conf)
+    in_.start()
+    return in_, port
+
+
+def server_conf(port, opts=''):
+    return "<server>\n host 127.0.0.1\n port %d\n %s\n</server>\n" % (port, opts)
+
+
+def make_output(port, conf=''):
+    Plugin.load_plugins()
+    if port is not None:
+        conf += '\n' + server_conf(port)
+    out = Plugin.new_output('forward')
+    out.configure(config.parse(io.BytesIO(
+        "<match>\n%s\n</match>\n" % (conf,)), 'test.conf').elements[0])
+    out.start()
+    return out
+
+
+def test_forward_modes():
+    in_ = CaptureInput()
+    t = msgpack.ExtType(0, struct.pack('!LL', 1, 500000000))
+    packed = msgpack.packb([t, {b'a': 1}])
+    c = zlib.compressobj(9, zlib.DEFLATED, 31)
+    compressed = c.compress(packed) + c.flush()
+    # Message, Forward, PackedForward and CompressedPackedForward
+    assert in_.on_message([b'tag', 1.5, {b'a': 1}, {b'chunk': b'c1'}]) == b'c1'
+    assert in_.on_message([b'tag', [[1.5, {b'a': 1}]], {b'chunk': b'c2'}]) == b'c2'
+    assert in_.on_message([b'tag', packed, {b'size': 1}]) is None
+    assert in_.on_message([b'tag', compressed,
+                           {b'compressed': b'gzip', b'size': 1}]) is None
+    assert in_.on_message([b'tag', packed, {b'compressed': b'unknown'}]) is None
+    assert in_.received == [(b'tag', 1, [(1.5, {b'a': 1})])] * 4
+
+
+def test_compressed_forward():
+    in_, port = start_input()
+    out = make_output(port, 'compress gzip')
+    entries = [(1, {b'a': 1}), (2, {b'b': 2})]
+    out.emit(b'tag', ArrayEventStream(entries))
+    assert out._buffer._map[b'tag'].compressed
+    out._buffer.flush()
+    gevent.sleep(0.05)
+    out.shutdown()
+    in_.shutdown()
+    assert in_.received == [(b'tag', 2, entries)]
+
+
+def test_connection_pool():
+    in_, port = start_input()
+    out = make_output(port, 'flush_mode immediate')
+    node = out._nodes[0]
+    for i in range(3):
+        out.emit(b'tag', OneEventStream(i, {}))
+        gevent.sleep(0.01)
+    assert len(in_.received) == 3
+    assert node.connect_count == 1
+
+    # the server is restarted
+    in_.shutdown()
+    in_, port = start_input(port)
+    out.emit(b'tag', OneEventStream(4, {}))
+    gevent.sleep(0.01)
+    assert len(in_.received) == 1
+    assert node.connect_count == 2
+
+    out.shutdown()
+    in_.shutdown()
+    assert node._idle == []
+
+
+def test_failure_detector():
+    d = FailureDetector(1.0, t=0)
+    for t in range(1, 11):
+        d.heartbeat(t)
+    assert d.phi(10.5) < 1
+    assert d.phi(14) > 16
+    d.heartbeat(14)
+    assert d.phi(14.1) < 1
+    assert d.phi(1e6) == FailureDetector.max_phi
+
+
+def test_weighted_servers():
+    inputs = [start_input() for i in range(3)]
+    conf = 'flush_mode immediate\nheartbeat_type none\n'
+    for (in_, port), opts in zip(inputs, ['weight 2', 'weight 1', 'standby true']):
+        conf += server_conf(port, opts)
+    out = make_output(None, conf)
+    for i in range(6):
+        out.emit(b'tag', OneEventStream(i, {}))
+        gevent.sleep(0.01)
+    assert [len(in_.received) for in_, port in inputs] == [4, 2, 0]
+
+    out._nodes[0].available = out._nodes[1].available = False
+    out.emit(b'tag', OneEventStream(6, {}))
+    gevent.sleep(0.01)
+    assert len(inputs[2][0].received) == 1
+    out.shutdown()
+    for in_, port in inputs:
+        in_.shutdown()
+
+
+def test_heartbeat(monkeypatch):
+    from fluenpy.engine import Engine
+    from fluenpy.plugins.in_monitor_agent import MonitorAgentInput
+
+    in_, port = start_input()
+    out = make_output(port, 'heartbeat_type udp\nheartbeat_interval 0.02')
+    node = out._nodes[0]
+    gevent.sleep(0.2)
+    assert node.available
+    assert len(node.detector._intervals) > 2
+
+    in_._hbserver.stop()
+    gevent.sleep(0.3)
+    assert not node.available
+
+    monkeypatch.setattr(Engine, 'plugins', lambda: [('output', out)])
+    agent = MonitorAgentInput()
+    assert 'Infinity' not in agent.plugins_json()
+    text = agent.prometheus()
+    assert 'fluenpy_forward_node_available{' in text
+    assert 'node="127.0.0.1:%d"' % (port,) in text
+    out.shutdown()
+    in_.shutdown()
+
+
+def test_send_failure_keeps_node_without_heartbeat():
+    port = free_port()
+    out = make_output(port, 'flush_mode immediate\nretry_wait 0.05')
+    out.emit(b'tag', OneEventStream(1, {}))
+    gevent.sleep(0.1)
+    node = out._nodes[0]
+    assert node.available
+    in_, port = start_input(port)
+    gevent.sleep(0.5)
+    assert len(in_.received) == 1
+    out.shutdown()
+    in_.shutdown()
+
+
+def test_ack_response():
+    in_, port = start_input()
+    out = make_output(port, 'flush_mode immediate\nrequire_ack_response true')
+    node = out._nodes[0]
+    for i in range(3):
+        out.emit(b'tag', OneEventStream(i, {}))
+        gevent.sleep(0.01)
+    assert len(in_.received) == 3
+    assert node.send_count == 3
+    assert node.connect_count == 1
+    assert node.metrics()['pending_acks'] == 0
+    out.shutdown()
+    in_.shutdown()
+
+
+class NoAckInput(CaptureInput):
+    def on_message(self, msg):
+        super(NoAckInput, self).on_message(msg)
+
+
+def test_ack_timeout():
+    in_ = NoAckInput()
+    port = free_port()
+    in_.configure({'bind': '127.0.0.1', 'port': str(port)})
+    in_.start()
+    out = make_output(port, 'ack_response_timeout 0.1')
+    node = out._nodes[0]
+    data = msgpack.packb([1, {}])
+    # both chunks wait for their ack on the same connection
+    sends = []
+    for id in (b'a', b'b'):
+        sends.append(gevent.spawn(out.send_data, node, b'tag', [data], {'chunk': id}))
+        gevent.sleep(0.02)
+    assert node.metrics()['pending_acks'] == 2
+    assert node.connect_count == 1
+    gevent.joinall(sends)
+    assert all(isinstance(g.exception, AckError) for g in sends)
+    assert len(in_.received) == 2
+    # the timed-out connection is closed, so the other ack fails too
+    assert node.ack_timeout_count == 1
+    assert node.error_count == 2
+    out.shutdown()
+    in_.shutdown()
+
+
+class DropAckInput(CaptureInput):
+    def on_message(self, msg):
+        self.received_ids = getattr(self, 'received_ids', [])
+        self.received_ids.append(super(DropAckInput, self).on_message(msg))
+
+
+def test_ack_chunk_id_is_kept_on_retry():
+    in_ = DropAckInput()
+    port = free_port()
+    in_.configure({'bind': '127.0.0.1', 'port': str(port)})
+    in_.start()
+    out = make_output(port, 'flush_mode immediate\nheartbeat_type none\n'
+                            'require_ack_response true\n'
+                            'ack_response_timeout 0.05\nretry_wait 0.05\n'
+                            'shutdown_timeout 0.1')
+    assert out.num_threads == out.ack_num_threads
+    out.emit(b'tag', OneEventStream(1, {}))
+    gevent.sleep(0.3)
+    ids = in_.received_ids
+    assert len(ids) >= 2
+    assert ids[0] and set(ids) == set(ids[:1])
+    out.shutdown()
+    in_.shutdown()
+
+    out = make_output(port, 'require_ack_response true\nnum_threads 2')
+    assert out.num_threads == 2
+    out.shutdown()
+
+
+def test_recv_buffer():
+    in_, port = start_input(recv_buffer_size='16', chunk_size_limit='100')
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(msgpack.packb([b'tag', 1, {b'a': b'x' * 50}]))
+    gevent.sleep(0.01)
+    assert in_.received == [(b'tag', 1, [(1, {b'a': b'x' * 50})])]
+    m = in_.metrics()
+    assert m['connections'] == 1
+    assert m['buffered_bytes'] == 16
+
+    # a message larger than chunk_size_limit closes the connection
+    sock.sendall(msgpack.packb([b'tag', 2, {b'a': b'x' * 200}]))
+    gevent.sleep(0.01)
+    assert len(in_.received) == 1
+    assert in_.metrics()['connections'] == 0
+    sock.close()
+    in_.shutdown()
+
+
+def test_recv_buffer_larger_than_chunk_size_limit():
+    in_, port = start_input(recv_buffer_size='4k', chunk_size_limit='100')
+    sock = socket.create_connection(('127.0.0.1', port))
+    data = b''.join(msgpack.packb([b'tag', i, {b'a': b'x' * 20}]) for i in range(1, 101))
+    assert len(data) > 2048
+    sock.sendall(data)
+    gevent.sleep(0.05)
+    assert [e[2][0][0] for e in in_.received] == list(range(1, 101))
+    assert in_.metrics()['connections'] == 1
+    sock.close()
+    in_.shutdown()
@@ -0,0 +1,309 @@
+from fluenpy.error import BufferQueueLimitError
+from fluenpy.event import OneEventStream
+from fluenpy.output import ObjectBufferedOutput, Output
+from fluenpy.plugin import Plugin
+import gevent
+import msgpack
+import pytest
+import zlib
+
+
+class SlowOutput(ObjectBufferedOutput):
+    def __init__(self):
+        super(SlowOutput, self).__init__()
+        self.written = []
+        self.running = 0
+        self.max_running = 0
+
+    def write(self, chunk):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        gevent.sleep(0.02)
+        self.written.append(chunk.key)
+        self.running -= 1
+
+
+def make_output(klass, **conf):
+    Plugin.load_plugins()
+    out = klass()
+    out.configure(dict((k, str(v)) for k, v in conf.items()))
+    out.start()
+    return out
+
+
+def test_num_threads():
+    out = make_output(SlowOutput, flush_thread_count=3, flush_interval=60)
+    assert out.num_threads == 3
+    for tag in ['a', 'b', 'c']:
+        out.emit(tag, OneEventStream(0, {'k': 'v'}))
+    out._buffer.flush()
+    gevent.sleep(0.05)
+    assert sorted(out.written) == ['a', 'b', 'c']
+    assert out.max_running == 3
+
+    workers = out.metrics()['flush_workers']
+    assert sorted(workers) == ['0', '1', '2']
+    assert all(w['write_count'] == 1 for w in workers.values())
+    assert all(0 < w['utilization'] <= 1 for w in workers.values())
+    out.shutdown()
+
+
+class ThreadOutput(ObjectBufferedOutput):
+    def write(self, chunk):
+        import threading
+        self.thread = threading.current_thread()
+
+
+def test_flush_thread_type_thread():
+    import threading
+    out = make_output(ThreadOutput, flush_thread_type='thread')
+    out.emit('a', OneEventStream(0, {'k': 'v'}))
+    out._buffer.flush()
+    gevent.sleep(0.05)
+    assert out.thread is not threading.current_thread()
+    out.shutdown()
+
+
+def test_retry_state():
+    from fluenpy.output import RetryState
+
+    retry = RetryState(1.0, 3, max_wait=3.0)
+    retry.jitter = 0
+    assert [retry.step() for _ in range(4)] == [1.0, 2.0, 3.0, 3.0]
+    assert retry.limit_reached
+    retry.reset()
+    assert retry.steps == 0 and not retry.limit_reached
+
+
+class FailOutput(ObjectBufferedOutput):
+    fail = True
+    written = ()
+
+    def write(self, chunk):
+        if self.fail:
+            raise IOError("down")
+        self.written += (chunk.read(),)
+
+
+Plugin.register_output('test_fail', FailOutput)
+
+
+def test_secondary():
+    from fluenpy import config
+    import io
+
+    conf = config.parse(io.BytesIO(
+        "<match>\n type test_fail\n retry_limit 1\n retry_wait 0.001\n"
+        " <secondary>\n </secondary>\n</match>\n"), 'test.conf')
+    Plugin.load_plugins()
+    out = Plugin.new_output('test_fail')
+    out.configure(conf.elements[0])
+    out._secondary.fail = False
+    out.start()
+    for i in range(3):
+        out.emit('a', OneEventStream(i, {}))
+        out._buffer.flush()
+    gevent.sleep(0.05)
+    assert len(out._secondary.written) == 3
+    assert out.secondary_write_count == 3
+    # retry only before the limit is reached first
+    assert out.num_errors == 4
+    assert out.retry_count == 1
+
+    out.fail = False
+    out.emit('a', OneEventStream(0, {}))
+    out._buffer.flush()
+    gevent.sleep(0.01)
+    assert len(out.written) == 1
+    assert out.flush_workers()[0].retry.steps == 0
+    out.shutdown()
+
+
+def test_time_sliced_output():
+    from fluenpy.event import ArrayEventStream
+    from fluenpy.output import TimeSlicedOutput
+
+    class SliceOutput(TimeSlicedOutput):
+        def write(self, chunk):
+            pass
+
+    out = make_output(SliceOutput, time_slice_format='%Y%m%d%H',
+                      time_slice_wait=60, utc=True)
+    t = 1362020400  # 2013-02-28 03:00:00 UTC
+    out.emit('a', ArrayEventStream([(t, {'n': 1}), (t + 3599, {'n': 2}),
+                                    (t + 3600, {'n': 3})]))
+    out.emit('b', ArrayEventStream([(t + 10, {'n': 4})]))
+    buf = out._buffer
+    assert sorted(buf.keys()) == ['2013022803', '2013022804']
+    assert buf._map['2013022803'].read().count(b'\n') == 3
+    assert buf._map['2013022803'].expire == t + 3600 + 60
+    assert buf._map['2013022804'].expire == t + 7200 + 60
+    out.shutdown()
+
+
+def test_emit_splits_by_records_limit():
+    from fluenpy.event import ArrayEventStream
+
+    out = make_output(SlowOutput, buffer_chunk_records_limit=3)
+    out.emit('a', ArrayEventStream([(i, {}) for i in range(7)]))
+    buf = out._buffer
+    chunks = [buf.get_nowait() for _ in range(2)]
+    chunks.append(buf._map['a'])
+    assert [(c.records, c.first_time, c.last_time) for c in chunks] == \
+        [(3, 0, 2), (3, 3, 5), (1, 6, 6)]
+
+
+def test_emit_split_stream_is_all_or_nothing():
+    from fluenpy.event import ArrayEventStream
+
+    out = make_output(SlowOutput, buffer_chunk_records_limit=2,
+                      buffer_queue_limit=2, flush_interval=60)
+    out.emit('b', ArrayEventStream([(i, {}) for i in range(3)]))
+    buf = out._buffer
+    assert buf._queue.qsize() == 1
+    bytes_in = out.bytes_in
+    with pytest.raises(BufferQueueLimitError):
+        out.emit('a', ArrayEventStream([(i, {}) for i in range(6)]))
+    assert buf._queue.qsize() == 1
+    assert 'a' not in buf._map or not buf._map['a'].records
+    assert out.bytes_in == bytes_in
+    out.shutdown()
+
+
+def test_emit_split_stream_larger_than_queue():
+    from fluenpy.event import ArrayEventStream
+
+    out = make_output(SlowOutput, buffer_chunk_records_limit=10,
+                      buffer_queue_limit=4, flush_interval=60)
+    out.emit('a', ArrayEventStream([(i, {}) for i in range(100)]))
+    buf = out._buffer
+    assert buf.metrics()['buffer_queue_length'] == 9
+    assert buf._map['a'].records == 10
+    # the queue limit still applies until the queue drains
+    with pytest.raises(BufferQueueLimitError):
+        out.emit('a', ArrayEventStream([(i, {}) for i in range(20)]))
+    out.shutdown()
+    assert out.written == ['a'] * 10
+
+
+def test_compressed_stream_is_stored_as_is():
+    from fluenpy.event import CompressedMessagePackEventStream
+
+    entries = [(1, {}), (2, {})]
+    c = zlib.compressobj(9, zlib.DEFLATED, 31)
+    member = c.compress(b''.join(map(msgpack.packb, entries))) + c.flush()
+    out = make_output(SlowOutput, compress='gzip', flush_interval=60)
+    out.emit('a', OneEventStream(0, {}))
+    out.emit('a', CompressedMessagePackEventStream(member))
+    chunk = out._buffer._map['a']
+    chunk.finish()
+    assert member in chunk.raw_read()
+    assert [tuple(e) for e in msgpack.Unpacker(chunk.open())] == [(0, {})] + entries
+    assert (chunk.records, chunk.first_time, chunk.last_time) == (3, 0, 2)
+    out.shutdown()
+
+
+class FullOutput(Output):
+    def emit(self, tag, es):
+        raise BufferQueueLimitError("queue is full")
+
+
+def test_copy_propagates_buffer_error():
+    from fluenpy.plugins.out_copy import CopyOutput
+
+    out = CopyOutput()
+    out._outputs = [FullOutput(), make_output(SlowOutput, flush_interval=60)]
+    with pytest.raises(BufferQueueLimitError):
+        out.emit('a', OneEventStream(0, {}))
+    # the other store still receives the stream
+    assert out._outputs[1]._buffer._map['a'].records == 1
+
+
+def test_copy_checks_every_store_first():
+    from fluenpy.plugins.out_copy import CopyOutput
+
+    out = CopyOutput()
+    out._outputs = [make_output(SlowOutput, flush_interval=60),
+                    make_output(SlowOutput, flush_mode='immediate',
+                                buffer_queue_limit=1)]
+    out.emit('a', OneEventStream(0, {}))
+    for i in range(3):
+        with pytest.raises(BufferQueueLimitError):
+            out.emit('a', OneEventStream(1, {}))
+    # the healthy store does not get a copy on each retry
+    assert out._outputs[0]._buffer._map['a'].records == 1
+    for o in out._outputs:
+        o.shutdown()
+
+
+def test_shutdown_drains_queue():
+    out = make_output(SlowOutput, flush_interval=60)
+    for tag in ['a', 'b', 'c']:
+        out.emit(tag, OneEventStream(0, {}))
+    out.shutdown()
+    assert sorted(out.written) == ['a', 'b', 'c']
+
+
+def test_shutdown_snapshot(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    out = make_output(FailOutput, snapshot_path=path, shutdown_timeout=0.1,
+                      retry_wait=1)
+    out.emit('a', OneEventStream(1, {}))
+    out._buffer.flush()
+    gevent.sleep(0.01)      # the worker is waiting to retry
+    out.emit('b', OneEventStream(2, {}))
+    out.shutdown()
+    assert tmpdir.join('snapshot').check()
+
+    out = make_output(FailOutput, snapshot_path=path)
+    out.fail = False
+    gevent.sleep(0.01)
+    assert not tmpdir.join('snapshot').check()
+    assert sorted(out.written) == sorted([OneEventStream(1, {}).to_mpac(),
+                                          OneEventStream(2, {}).to_mpac()])
+    out.shutdown()
+
+
+def test_shutdown_snapshot_per_worker(tmpdir, monkeypatch):
+    from fluenpy.engine import Engine
+
+    path = str(tmpdir.join('snapshot'))
+    monkeypatch.setattr(Engine, 'workers', 2)
+    for worker_id in (0, 1):
+        monkeypatch.setattr(Engine, 'worker_id', worker_id)
+        out = make_output(FailOutput, snapshot_path=path, shutdown_timeout=0)
+        out.emit('a', OneEventStream(worker_id + 1, {}))
+        out.shutdown()
+    assert tmpdir.join('worker0', 'snapshot').check()
+    assert tmpdir.join('worker1', 'snapshot').check()
+
+    out = make_output(FailOutput, snapshot_path=path)
+    assert out._buffer.metrics()['buffer_queue_length'] == 1
+    assert not tmpdir.join('worker1', 'snapshot').check()
+    assert tmpdir.join('worker0', 'snapshot').check()
+    out.fail = False
+    out.shutdown()
+
+
+def test_shutdown_file_buffer_keeps_chunks(tmpdir):
+    conf = dict(buffer_type='file', buffer_path=str(tmpdir.join('buf')),
+                flush_at_shutdown='false', shutdown_timeout=0.1, retry_wait=1)
+    out = make_output(FailOutput, **conf)
+    out.emit('a', OneEventStream(1, {}))
+    out._buffer.flush()
+    gevent.sleep(0.01)      # the worker is waiting to retry
+    out.emit('b', OneEventStream(2, {}))
+    out.shutdown()
+    assert len(tmpdir.listdir('buf.*.q*.log')) == 1
+    assert len(tmpdir.listdir('buf.*.b*.log')) == 1
+
+    out = make_output(FailOutput, **conf)
+    assert len(out._buffer._queue.queue) == 1
+    assert list(out._buffer.keys()) == ['b']
+    out.fail = False
+    out._buffer.flush()
+    gevent.sleep(0.01)
+    assert sorted(out.written) == sorted([OneEventStream(1, {}).to_mpac(),
+                                          OneEventStream(2, {}).to_mpac()])
+    out.shutdown()
+    assert tmpdir.listdir('buf.*') == []